@@ -1,14 +1,27 @@
 """Test EC2 JSON api. See https://github.com/nsh87/medicare-claims-query-api
 for more info on the code base.
+
+For scripts that make many calls, use a `Client`: it keeps connections open
+between calls, runs calls in parallel with `fetch_many()`, retries failed
+calls with backoff, and can cache responses on disk, revalidating them with
+the server's ETags. The module-level functions use a shared `Client`.
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import json
-import urllib2
 import os
+import tempfile
+import threading
+import time
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 SERVER = 'http://localhost:7000'
 
@@ -16,113 +29,383 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 if os.path.isfile(os.path.join(current_dir, 'PRODUCTION')):
     SERVER = 'http://52.32.95.188'
 
+# Overrides SERVER, e.g. 'http://localhost:5000'
+SERVER_ENV_VAR = 'MEDICARE_API_SERVER'
 
-def get_counts(col):
+# Status codes that are retried, e.g. when admission control rejects a call
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class ResponseCache(object):
     """
-    Get counts by distinct values in a given column.
+    An on-disk cache of response bodies and their ETags, keyed by URL and
+    Accept header. Entries are written atomically, so a cache directory can
+    be shared by threads and processes.
 
     Parameters
     ----------
-    col : str, unicode
-        Column to count distinct values within.
-
-    Returns
-    -------
-    dict
-        A dictionary of values and counts.
+    directory : str, unicode
+        Directory to store the entries in, created if needed.
     """
-    out = dict()
-    response = urllib2.urlopen(SERVER + '/api/v1/count/' + col)
-    out = response.read()
-    return json.loads(out)
 
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
 
-def get_state_disease_freq(disease):
+    def _path(self, url, accept):
+        key = hashlib.sha1('{0} {1}'.format(url, accept).encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest())
+
+    def get(self, url, accept):
+        """
+        Get a cached response.
+
+        Returns
+        -------
+        (str, unicode, bytes) or None
+            The ETag and body of the response, or None if it isn't cached.
+        """
+        path = self._path(url, accept)
+        try:
+            with open(path, 'rb') as f:
+                etag = f.readline().rstrip(b'\n').decode('ascii')
+                return etag, f.read()
+        except IOError:
+            return None
+
+    def set(self, url, accept, etag, body):
+        """Cache the ETag and body of a response."""
+        path = self._path(url, accept)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(etag.encode('ascii') + b'\n')
+            f.write(body)
+        os.rename(tmp_path, path)
+
+
+class Client(object):
     """
-    Get the frequency of disease claims by state in descending order.
+    A client of the API that keeps its connections open between calls.
 
     Parameters
     ----------
-    disease : str, unicode
-        A disease corresponding to a column name.
-
-    Returns
-    -------
-    list
-        A list of dictionaries with state abbreviation as keys and frequency
-        of disease claims as value.
+    server : str, unicode, optional
+        Base URL of the API. Defaults to the MEDICARE_API_SERVER environment
+        variable if it is set, otherwise SERVER.
+    cache_dir : str, unicode, optional
+        Directory to cache responses in. Cached responses are revalidated
+        with the server's ETag on every call, so they are never stale, but
+        an unchanged result isn't downloaded again. No caching if not given.
+    workers : int
+        Number of calls `fetch_many()` runs at once. Also the number of
+        connections kept open.
+    retries : int
+        Number of times a call is retried after a connection error or a
+        RETRY_STATUSES response.
+    backoff : float
+        Retries wait backoff * 2 ** (retry number - 1) seconds, or as long as
+        the response's Retry-After header asks if that is longer.
+    timeout : float
+        Seconds to wait for the server to respond.
     """
-    out = dict()
-    print(SERVER + '/api/v1/freq/' + disease)
-    response = urllib2.urlopen(SERVER + '/api/v1/freq/' + disease)
-    out = response.read()
-    return json.loads(out)
+
+    def __init__(self, server=None, cache_dir=None, workers=8, retries=3,
+                 backoff=0.5, timeout=60):
+        if server is None:
+            server = os.environ.get(SERVER_ENV_VAR, SERVER)
+        self.server = server.rstrip('/')
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.timeout = timeout
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        # Error statuses are retried by `get()` instead, since the bundled
+        # urllib3 ignores Retry-After and raises RetryError once it gives up
+        retry = Retry(total=retries, backoff_factor=backoff)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get(self, path, accept='application/json'):
+        """
+        Request an API path, using the cached response if it is still valid.
+
+        Parameters
+        ----------
+        path : str, unicode
+            The API path, e.g. '/api/v1/count/race'.
+        accept : str, unicode
+            The mimetype to ask for.
+
+        Returns
+        -------
+        bytes
+            The body of the response.
+
+        Raises
+        ------
+        requests.HTTPError
+            If the server returns an error status, or one of RETRY_STATUSES
+            on every retry.
+        """
+        url = self.server + path
+        headers = {'Accept': accept}
+        cached = self.cache.get(url, accept) if self.cache else None
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        for attempt in range(self.retries + 1):
+            response = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+            if response.status_code not in RETRY_STATUSES or \
+                    attempt == self.retries:
+                break
+            time.sleep(self._retry_delay(response, attempt))
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
+        response.raise_for_status()
+        etag = response.headers.get('ETag')
+        if self.cache and etag:
+            self.cache.set(url, accept, etag, response.content)
+        return response.content
+
+    def _retry_delay(self, response, attempt):
+        delay = self.backoff * 2 ** attempt
+        try:
+            return max(delay, float(response.headers.get('Retry-After', 0)))
+        except ValueError:
+            # An HTTP date, which the server doesn't send
+            return delay
+
+    def get_json(self, path):
+        """Request an API path and decode its JSON response."""
+        return json.loads(self.get(path).decode('utf-8'))
+
+    def get_counts(self, col):
+        """
+        Get counts by distinct values in a given column.
+
+        Parameters
+        ----------
+        col : str, unicode
+            Column to count distinct values within.
+
+        Returns
+        -------
+        dict
+            A dictionary of values and counts.
+        """
+        return self.get_json('/api/v1/count/' + col)
+
+    def get_state_disease_freq(self, disease):
+        """
+        Get the frequency of disease claims by state in descending order.
+
+        Parameters
+        ----------
+        disease : str, unicode
+            A disease corresponding to a column name.
+
+        Returns
+        -------
+        list
+            A list of dictionaries with state abbreviation as keys and
+            frequency of disease claims as value.
+        """
+        return self.get_json('/api/v1/freq/' + disease)
+
+    def get_avg_col(self, col):
+        """
+        Get the average value of a column.
+
+        Parameters
+        ----------
+        col : str, unicode
+            The column to get the average of.
+
+        Returns
+        -------
+        dict
+            A dictionary whose key is the column name and the value is the
+            average value of that column.
+        """
+        return self.get_json('/api/v1/average/{0}'.format(col))['average']
+
+    def get_arrow(self, path):
+        """
+        Get the result of an API call as an Arrow table.
+
+        Parameters
+        ----------
+        path : str, unicode
+            The API path to request, e.g. '/api/v1/count/race' or
+            '/api/v1/rows?state=CA'.
+
+        Returns
+        -------
+        pyarrow.Table
+            A table whose columns keep their types, so it can be turned into
+            a dataframe with `table.to_pandas()`.
+        """
+        import pyarrow as pa
+        buf = pa.py_buffer(self.get(path,
+                                    'application/vnd.apache.arrow.stream'))
+        return pa.ipc.open_stream(buf).read_all()
+
+    def get_parquet(self, path):
+        """
+        Get the result of an API call, transferred as Parquet, as an Arrow
+        table.
+
+        Parameters
+        ----------
+        path : str, unicode
+            The API path to request, e.g. '/api/v1/rows?cols=sex,cancer'.
+
+        Returns
+        -------
+        pyarrow.Table
+            The decoded table.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        buf = pa.py_buffer(self.get(path, 'application/vnd.apache.parquet'))
+        return pq.read_table(pa.BufferReader(buf))
+
+    def fetch_many(self, calls):
+        """
+        Make several calls in parallel.
+
+        Parameters
+        ----------
+        calls : iterable of tuple
+            The name of a method of the client followed by its arguments,
+            for each call, e.g. ``[('get_counts', 'sex'),
+            ('get_avg_col', 'carrier_reimbursement')]``.
+
+        Returns
+        -------
+        list
+            The result of each call, in the same order.
+
+        Raises
+        ------
+        Exception
+            The exception of the first call that failed, if any did, e.g. a
+            requests.HTTPError if the server kept returning an error status.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [self._executor.submit(getattr(self, call[0]), *call[1:])
+                   for call in calls]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Close the client's connections and threads."""
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Get the Client shared by the module-level functions."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+    return _client
+
+
+def get_counts(col):
+    """Get counts by distinct values in a given column, see `Client`."""
+    return get_client().get_counts(col)
+
+
+def get_state_disease_freq(disease):
+    """Get the frequency of disease claims by state, see `Client`."""
+    return get_client().get_state_disease_freq(disease)
 
 
 def get_avg_col(col):
-    """
-    Get the average value of a column.
+    """Get the average value of a column, see `Client`."""
+    return get_client().get_avg_col(col)
 
-    Parameters
-    ----------
-    col : str, unicode
-        The column to get the average of.
-
-    Returns
-    -------
-    dict
-        A dictionary whose key is the column name and the value is the average
-        value of that column.
-    """
-    out = dict()
-    response = urllib2.urlopen(SERVER + '/api/v1/average/{0}'.format(col))
-    results = json.loads(response.read())
-    return results['average']
+
+def get_arrow(path):
+    """Get the result of an API call as an Arrow table, see `Client`."""
+    return get_client().get_arrow(path)
+
+
+def get_parquet(path):
+    """Get the result of an API call via Parquet, see `Client`."""
+    return get_client().get_parquet(path)
 
 
 if __name__ == '__main__':
+    client = get_client()
+    started = time.time()
+    (sex_counts, heart_failure_counts, depression_rates, diabetes_rates,
+     inpatient_avg, outpatient_avg, responsibility_avg) = client.fetch_many([
+        ('get_counts', 'sex'),
+        ('get_counts', 'heart_failure'),
+        ('get_state_disease_freq', 'depression'),
+        ('get_state_disease_freq', 'diabetes'),
+        ('get_avg_col', 'inpatient_reimbursement'),
+        ('get_avg_col', 'outpatient_reimbursement'),
+        ('get_avg_col', 'beneficiary_responsibility'),
+    ])
+    elapsed = time.time() - started
     print("*********************************************")
-    print("test of my flask app runn at {0}".format(SERVER))
+    print("test of my flask app runn at {0}".format(client.server))
     print("created by Nikhil Haas")
     print("*********************************************")
     print("")
     print("*********** count claims by sex *************")
-    for k, v in get_counts('sex').iteritems():
+    for k, v in sex_counts.iteritems():
         print("{0}: {1}".format(k, v))
     print("*********************************************")
     print("")
     print("******* count heart failures claims *********")
-    for k, v in get_counts('heart_failure').iteritems():
+    for k, v in heart_failure_counts.iteritems():
         print("{0}: {1}".format(k, v))
     print("*********************************************")
     print("")
     print("**** get rate of state depression claims ****")
-    depression_rates = get_state_disease_freq('depression')
     for state in depression_rates['state_depression']:
         print("{0}: {1}".format(state.keys()[0], state.values()[0]))
     print("*********************************************")
     print("")
     print("********** get most diabetic states *********")
-    diabetes_rates = get_state_disease_freq('diabetes')
     for state in diabetes_rates['state_depression']:
         print("{0}: {1}".format(state.keys()[0], state.values()[0]))
     print("*********************************************")
     print("")
     print("****** average inpatient reimbursement ******")
-    reimb = get_avg_col('inpatient_reimbursement')
+    reimb = inpatient_avg
     print("{0}: {1}".format(reimb.keys()[0], reimb.values()[0]))
     print("*********************************************")
     print("")
     print("***** average outpatient reimbursement ******")
-    reimb = get_avg_col('outpatient_reimbursement')
+    reimb = outpatient_avg
     print("{0}: {1}".format(reimb.keys()[0], reimb.values()[0]))
     print("*********************************************")
     print("")
     print("**** average beneficiary responsibility *****")
-    reimb = get_avg_col('beneficiary_responsibility')
+    reimb = responsibility_avg
     print("{0}: {1}".format(reimb.keys()[0], reimb.values()[0]))
     print("*********************************************")
     print("")
+    print("Fetched in {0:.2f} seconds.".format(elapsed))
+    print("")
     print("The data is synthetic: a 5% sample from actual 2010 Medicare\n"
           "beneficiary data. The columns were sampled independently,\n"
           "so multivariate analysis is not advised since it could lead\n"
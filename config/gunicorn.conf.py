@@ -0,0 +1,31 @@
+"""Gunicorn settings and server hooks for the Flask app."""
+
+# Serve requests on threads so the server's per-endpoint admission limits can
+# take effect
+threads = 8
+
+# Load the app once in the master, so workers are forked with it already
+# imported and warmed up, sharing its memory until they write to it
+preload_app = True
+
+
+def when_ready(arbiter):
+    """
+    Fill the result caches in the master before any worker is forked.
+    `warm_up()` cancels and waits for its queries when its time budget runs
+    out, so no thread is left holding a lock for the workers to inherit.
+    """
+    import server
+    server.warm_up()
+    # Don't let the workers inherit the connections used for the warm-up
+    server.reset_connections()
+
+
+def post_fork(arbiter, worker):
+    """
+    Make sure the new worker opens its own DB connections, and have it drop
+    its caches whenever the data loader reloads the table.
+    """
+    import server
+    server.reset_connections(close=False)
+    server.listen_for_reloads()
@@ -0,0 +1,191 @@
+"""Per-endpoint admission control, so a burst of requests to an expensive
+endpoint can't tie up every DB connection and slow down the cheap ones.
+
+Each endpoint may run a limited number of requests at once. Requests beyond
+that wait in a bounded queue for a limited time; when the queue is full or the
+wait runs out the request is rejected with `Overloaded`, which the server
+turns into a fast 503 response.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted, or when its query was cancelled
+    by the statement timeout.
+
+    Attributes
+    ----------
+    endpoint : str, unicode
+        The endpoint that is overloaded.
+    retry_after : int
+        Seconds the client should wait before retrying.
+    """
+
+    def __init__(self, endpoint, retry_after):
+        super(Overloaded, self).__init__(
+            "endpoint '{0}' is overloaded".format(endpoint))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class AdmissionLimit(object):
+    """
+    The limits of one endpoint.
+
+    Parameters
+    ----------
+    concurrency : int
+        Requests that may run at once.
+    queue_size : int
+        Requests that may wait for a slot at once.
+    queue_timeout : float
+        Seconds a request may wait for a slot.
+    statement_timeout : int or None
+        Milliseconds a query of the endpoint may run before Postgres cancels
+        it, or None for no limit.
+    retry_after : int
+        Seconds rejected clients are told to wait before retrying.
+    """
+
+    def __init__(self, concurrency, queue_size, queue_timeout,
+                 statement_timeout=None, retry_after=1):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.statement_timeout = statement_timeout
+        self.retry_after = retry_after
+
+
+class _Lane(object):
+    """The slots, wait queue and counters of one endpoint."""
+
+    def __init__(self, endpoint, limit):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def acquire(self):
+        limit = self.limit
+        with self.condition:
+            if self.active >= limit.concurrency:
+                if self.waiting >= limit.queue_size:
+                    self.rejected += 1
+                    raise Overloaded(self.endpoint, limit.retry_after)
+                self.waiting += 1
+                deadline = time.time() + limit.queue_timeout
+                try:
+                    while self.active >= limit.concurrency:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise Overloaded(self.endpoint, limit.retry_after)
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+class AdmissionController(object):
+    """
+    Admission control for a set of endpoints.
+
+    Parameters
+    ----------
+    limits : dict
+        AdmissionLimit of each endpoint, by endpoint name.
+    default : AdmissionLimit
+        Limit of endpoints not in `limits`.
+    """
+
+    def __init__(self, limits, default):
+        self._default = default
+        self._lanes = dict((endpoint, _Lane(endpoint, limit))
+                           for endpoint, limit in limits.items())
+        self._lock = threading.Lock()
+
+    def _lane(self, endpoint):
+        with self._lock:
+            if endpoint not in self._lanes:
+                self._lanes[endpoint] = _Lane(endpoint, self._default)
+            return self._lanes[endpoint]
+
+    def limit(self, endpoint):
+        """Get the AdmissionLimit of an endpoint."""
+        return self._lane(endpoint).limit
+
+    def acquire(self, endpoint):
+        """
+        Take a slot for a request to an endpoint, waiting for one if needed.
+        Every call that returns must be paired with a call to `release()`.
+
+        Raises
+        ------
+        Overloaded
+            If the queue is full or no slot frees up in time.
+        """
+        self._lane(endpoint).acquire()
+
+    def release(self, endpoint):
+        """Give back a slot taken with `acquire()`."""
+        self._lane(endpoint).release()
+
+    @contextmanager
+    def admit(self, endpoint):
+        """Hold a slot for a request to an endpoint for a block of code."""
+        self.acquire(endpoint)
+        try:
+            yield
+        finally:
+            self.release(endpoint)
+
+    def record_cancel(self, endpoint):
+        """Count a query of an endpoint cancelled by its statement timeout."""
+        lane = self._lane(endpoint)
+        with lane.condition:
+            lane.cancelled += 1
+
+    def stats(self):
+        """
+        Get the state and counters of each endpoint.
+
+        Returns
+        -------
+        dict
+            For each endpoint, the number of requests running ('active') and
+            queued ('waiting'), and the totals admitted, rejected and
+            cancelled by the statement timeout.
+        """
+        with self._lock:
+            lanes = list(self._lanes.values())
+        stats = {}
+        for lane in lanes:
+            with lane.condition:
+                stats[lane.endpoint] = {
+                    'active': lane.active,
+                    'waiting': lane.waiting,
+                    'admitted': lane.admitted,
+                    'rejected': lane.rejected,
+                    'cancelled': lane.cancelled,
+                    'concurrency': lane.limit.concurrency,
+                    'queue_size': lane.limit.queue_size,
+                }
+        return stats
@@ -0,0 +1,85 @@
+"""Thread-safe in-process cache of query results."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+
+
+class ResultCache(object):
+    """
+    A dict of query results shared by the threads of a worker, with hit and
+    miss counters.
+
+    The data is only changed by a reload of the whole table, so entries
+    don't expire; call `clear()` when the table is reloaded.
+
+    Attributes
+    ----------
+    generation : int
+        Incremented by every `clear()`. A result computed from a query that
+        started before a clear is from the old data, so pass the generation
+        read before the query to `set()` and the result is dropped.
+    """
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get(self, key):
+        """
+        Get a cached result.
+
+        Parameters
+        ----------
+        key : hashable
+            The key the result was stored under.
+
+        Returns
+        -------
+        object or None
+            The result, or None if it isn't cached.
+        """
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def set(self, key, result, generation=None):
+        """
+        Store a result under a key.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to store the result under.
+        result : object
+            The result.
+        generation : int, optional
+            The cache's `generation` when the result's query started. The
+            result isn't stored if the cache has been cleared since.
+        """
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self._results[key] = result
+
+    def clear(self):
+        """Drop all cached results."""
+        with self._lock:
+            self._results.clear()
+            self.generation += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._results
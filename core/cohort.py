@@ -0,0 +1,238 @@
+"""In-memory compressed bitmap index for counting cohorts of beneficiaries.
+
+Every row of the table is given a position, and each attribute value (a
+disease flag, a sex, a race or a state) gets a roaring bitmap of the positions
+of the rows that have it. A cohort expression such as::
+
+    diabetes AND heart_failure AND NOT (state:CA OR state:NV)
+
+is then answered with a few bitmap intersections, unions and differences
+instead of a scan of the table.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+
+from pyroaring import BitMap
+
+from db import schema
+
+# Attributes that are matched with 'attribute:value' terms
+VALUE_ATTRIBUTES = ('sex', 'race', 'state')
+
+# Deepest nesting of NOTs and parentheses allowed in an expression, which
+# keeps the parser well within Python's recursion limit
+MAX_NESTING = 50
+
+_TOKEN_RE = re.compile(r'\s*(\(|\)|[A-Za-z_]+(?::[A-Za-z_]+)?)')
+
+
+def tokenize(expression):
+    """
+    Split a cohort expression into tokens.
+
+    Parameters
+    ----------
+    expression : str, unicode
+        The expression, e.g. 'diabetes AND (sex:male OR state:CA)'.
+
+    Returns
+    -------
+    list of str, unicode
+        The parentheses, operators and terms in the expression.
+
+    Raises
+    ------
+    ValueError
+        If the expression contains characters that aren't part of a token.
+    """
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match:
+            raise ValueError("unexpected character '{0}' in query".format(
+                             expression[pos:].lstrip()[:1]))
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class CohortIndex(object):
+    """
+    Bitmaps of the rows having each disease flag, sex, race and state.
+
+    Build an index with `CohortIndex.build()`. Once built the index is
+    read-only, so it can be shared between threads.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.universe = BitMap()
+        self.bitmaps = {}
+
+    @classmethod
+    def build(cls, cursors, table_name, batch_size=65536, queries=None):
+        """
+        Build the index with a single scan of the table.
+
+        Parameters
+        ----------
+        cursors : list of psycopg2.extensions.cursor
+            A cursor to read the table with on each shard; preferably named
+            cursors so the rows are streamed instead of loaded all at once.
+            Rows are given positions shard by shard.
+        table_name : str, unicode
+            The table to index.
+        batch_size : int
+            Number of row positions collected in lists before they are added
+            to the bitmaps, which bounds the memory used during the build.
+        queries : core.utilities.QueryGroup, optional
+            The group the cursors' connections are in. Cancelling it only
+            interrupts a fetch in progress, so the build also checks it every
+            `batch_size` rows and stops once it is cancelled.
+
+        Returns
+        -------
+        CohortIndex
+
+        Raises
+        ------
+        QueriesCancelled
+            Or the error of `queries`, if it was cancelled.
+        """
+        index = cls()
+        cols = VALUE_ATTRIBUTES + schema.DISEASE_COLUMNS
+        for col in schema.DISEASE_COLUMNS:
+            index.bitmaps[col] = BitMap()
+        for col, values in (('sex', schema.SEX_VALUES),
+                            ('race', schema.RACE_VALUES),
+                            ('state', schema.STATE_VALUES)):
+            for val in values:
+                index.bitmaps['{0}:{1}'.format(col, val)] = BitMap()
+        pending = dict((term, []) for term in index.bitmaps)
+        sql = "SELECT {0} FROM {1};".format(", ".join(cols), table_name)
+        pos = 0
+        for cur in cursors:
+            cur.execute(sql)
+            for row in cur:
+                for col, val in zip(VALUE_ATTRIBUTES, row):
+                    term = '{0}:{1}'.format(col, val)
+                    if term in pending:
+                        pending[term].append(pos)
+                for col, flag in zip(schema.DISEASE_COLUMNS, row[3:]):
+                    if flag:
+                        pending[col].append(pos)
+                pos += 1
+                if pos % batch_size == 0:
+                    if queries is not None and queries.cancelled:
+                        raise queries.error()
+                    index._flush(pending)
+        index._flush(pending)
+        index.size = pos
+        index.universe.add_range(0, pos)
+        for bitmap in index.bitmaps.values():
+            bitmap.run_optimize()
+        return index
+
+    def _flush(self, pending):
+        for term, positions in pending.items():
+            if positions:
+                self.bitmaps[term].update(positions)
+                pending[term] = []
+
+    def evaluate(self, expression):
+        """
+        Evaluate a cohort expression.
+
+        Terms are disease column names, which match rows with that disease,
+        or 'sex:<value>', 'race:<value>' and 'state:<value>'. Terms are
+        combined with AND, OR and NOT, and grouped with parentheses. NOT binds
+        tighter than AND, which binds tighter than OR.
+
+        Parameters
+        ----------
+        expression : str, unicode
+            The cohort expression.
+
+        Returns
+        -------
+        pyroaring.BitMap
+            The positions of the rows in the cohort.
+
+        Raises
+        ------
+        ValueError
+            If the expression is malformed, has an unknown term or is nested
+            more than MAX_NESTING deep.
+        """
+        tokens = tokenize(expression)
+        if not tokens:
+            raise ValueError("query is empty")
+        result, pos = self._parse_or(tokens, 0, 0)
+        if pos != len(tokens):
+            raise ValueError("unexpected '{0}' in query".format(tokens[pos]))
+        return result
+
+    def state_counts(self, cohort):
+        """
+        Count the rows of a cohort in each state.
+
+        Parameters
+        ----------
+        cohort : pyroaring.BitMap
+            A result of `evaluate()`.
+
+        Returns
+        -------
+        dict
+            State abbreviations and counts, for states with at least one row.
+        """
+        counts = {}
+        for state in schema.STATE_VALUES:
+            bitmap = self.bitmaps['state:{0}'.format(state)]
+            num = cohort.intersection_cardinality(bitmap)
+            if num:
+                counts[state] = num
+        return counts
+
+    def _parse_or(self, tokens, pos, depth):
+        result, pos = self._parse_and(tokens, pos, depth)
+        while pos < len(tokens) and tokens[pos].upper() == 'OR':
+            rhs, pos = self._parse_and(tokens, pos + 1, depth)
+            result = result | rhs
+        return result, pos
+
+    def _parse_and(self, tokens, pos, depth):
+        result, pos = self._parse_not(tokens, pos, depth)
+        while pos < len(tokens) and tokens[pos].upper() == 'AND':
+            rhs, pos = self._parse_not(tokens, pos + 1, depth)
+            result = result & rhs
+        return result, pos
+
+    def _parse_not(self, tokens, pos, depth):
+        if pos >= len(tokens):
+            raise ValueError("query ended unexpectedly")
+        token = tokens[pos]
+        if token.upper() == 'NOT' or token == '(':
+            depth += 1
+            if depth > MAX_NESTING:
+                raise ValueError("query is nested more than {0} deep".format(
+                                 MAX_NESTING))
+        if token.upper() == 'NOT':
+            operand, pos = self._parse_not(tokens, pos + 1, depth)
+            return self.universe - operand, pos
+        if token == '(':
+            result, pos = self._parse_or(tokens, pos + 1, depth)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ValueError("missing ')' in query")
+            return result, pos + 1
+        if token == ')' or token.upper() in ('AND', 'OR'):
+            raise ValueError("unexpected '{0}' in query".format(token))
+        if token not in self.bitmaps:
+            raise ValueError("unknown term '{0}' in query".format(token))
+        return self.bitmaps[token], pos + 1
@@ -0,0 +1,186 @@
+"""Serialize query results as Apache Arrow IPC streams or Parquet files.
+
+Results are converted column by column straight from the tuples returned by
+psycopg2, so there is no intermediate dict per row, and each column keeps its
+type: the sex, race and state columns are dictionary encoded, booleans stay
+booleans and dates stay dates.
+
+pyarrow is imported on first use rather than with this module, since it is
+slow to import and only the binary formats need it.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from db import schema
+
+ARROW = 'arrow'
+PARQUET = 'parquet'
+MIMETYPES = {
+    ARROW: 'application/vnd.apache.arrow.stream',
+    PARQUET: 'application/vnd.apache.parquet',
+}
+
+# Kinds of column that only exist in aggregate results
+FLOAT = 'float'
+BIGINT = 'bigint'
+
+# Fixed dictionaries so every batch of a stream shares the same encoding
+_DICTIONARIES = {
+    schema.SEX: schema.SEX_VALUES,
+    schema.RACE: schema.RACE_VALUES,
+    schema.STATE: schema.STATE_VALUES,
+}
+
+# Names of the pyarrow type factories of the other kinds
+_ARROW_TYPES = {
+    schema.CHAR: 'string',
+    schema.DATE: 'date32',
+    schema.BOOLEAN: 'bool_',
+    schema.INTEGER: 'int32',
+    FLOAT: 'float64',
+    BIGINT: 'int64',
+}
+
+
+def arrow_type(kind):
+    """
+    Get the Arrow type used for a kind of column.
+
+    Parameters
+    ----------
+    kind : str, unicode
+        A column kind from `db.schema`, or `FLOAT` or `BIGINT`.
+
+    Returns
+    -------
+    pyarrow.DataType
+    """
+    import pyarrow as pa
+    if kind in _DICTIONARIES:
+        return pa.dictionary(pa.int8(), pa.string())
+    return getattr(pa, _ARROW_TYPES[kind])()
+
+
+def arrow_schema(names, kinds):
+    """
+    Make an Arrow schema for columns with the given names and kinds.
+
+    Parameters
+    ----------
+    names : sequence of str, unicode
+        Column names.
+    kinds : sequence of str, unicode
+        The kind of each column, see `arrow_type()`.
+
+    Returns
+    -------
+    pyarrow.Schema
+    """
+    import pyarrow as pa
+    return pa.schema([pa.field(name, arrow_type(kind))
+                      for name, kind in zip(names, kinds)])
+
+
+def _to_array(values, kind):
+    import pyarrow as pa
+    if kind in _DICTIONARIES:
+        dictionary = _DICTIONARIES[kind]
+        lookup = dict((val, i) for i, val in enumerate(dictionary))
+        indices = pa.array([lookup.get(val) for val in values], type=pa.int8())
+        return pa.DictionaryArray.from_arrays(indices, pa.array(dictionary))
+    return pa.array(values, type=arrow_type(kind))
+
+
+def record_batch(names, kinds, rows):
+    """
+    Convert rows returned by a cursor into an Arrow record batch.
+
+    Parameters
+    ----------
+    names : sequence of str, unicode
+        Column names.
+    kinds : sequence of str, unicode
+        The kind of each column, see `arrow_type()`.
+    rows : list of tuple
+        Rows as returned by `cursor.fetchall()` or `cursor.fetchmany()`.
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+    """
+    import pyarrow as pa
+    if rows:
+        columns = list(zip(*rows))
+    else:
+        columns = [[] for _ in names]
+    arrays = [_to_array(list(col), kind) for col, kind in zip(columns, kinds)]
+    return pa.RecordBatch.from_arrays(arrays, list(names))
+
+
+class _ChunkSink(object):
+    """
+    A write-only file-like object that Arrow writers can write to, whose
+    contents are drained as each batch is written so they can be streamed.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = memoryview(data).tobytes()
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_batches(batches, batch_schema, fmt):
+    """
+    Serialize record batches, yielding the bytes written for each batch.
+
+    Parameters
+    ----------
+    batches : iterable of pyarrow.RecordBatch
+        Batches to write, which must all have the schema `batch_schema`.
+    batch_schema : pyarrow.Schema
+        Schema of the batches.
+    fmt : {'arrow', 'parquet'}
+        Write an Arrow IPC stream or a Parquet file with one row group per
+        batch.
+
+    Yields
+    ------
+    bytes
+        The serialized data, in order.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sink = _ChunkSink()
+    if fmt == PARQUET:
+        writer = pq.ParquetWriter(sink, batch_schema)
+    else:
+        writer = pa.RecordBatchStreamWriter(sink, batch_schema)
+    for batch in batches:
+        if fmt == PARQUET:
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
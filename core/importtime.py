@@ -0,0 +1,111 @@
+"""Measure how long each module takes to import, to find what slows down the
+startup of Gunicorn workers.
+
+Run it on a module from the root of the repository, e.g.::
+
+    python -m core.importtime wsgi
+    python -m core.importtime server --limit 30
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import importlib
+import sys
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+
+def profile_imports(module_name):
+    """
+    Import a module, timing every module it imports for the first time.
+
+    Parameters
+    ----------
+    module_name : str, unicode
+        The module to import. It must not have been imported already.
+
+    Returns
+    -------
+    list of tuple
+        A (name, depth, cumulative, self) tuple for each module, in the order
+        their imports finished, where cumulative is the seconds taken to
+        import the module and everything it imported, and self excludes the
+        modules it imported.
+    """
+    original_import = builtins.__import__
+    timings = []
+    # Seconds spent importing children, for each import in progress
+    child_times = []
+
+    def timed_import(name, *args, **kwargs):
+        fromlist = args[2] if len(args) > 2 else kwargs.get('fromlist')
+        # `from package import module` imports the module without its name
+        # being the one imported
+        targets = [name] + ['{0}.{1}'.format(name, item)
+                            for item in fromlist or () if item != '*']
+        missing = [target for target in targets if target not in sys.modules]
+        if not missing:
+            return original_import(name, *args, **kwargs)
+        num_modules = len(sys.modules)
+        child_times.append(0.0)
+        start = time.time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = child_times.pop()
+            # Names in the fromlist may be attributes rather than modules, in
+            # which case nothing new was imported
+            if len(sys.modules) > num_modules:
+                if child_times:
+                    child_times[-1] += elapsed
+                loaded = [target for target in missing
+                          if target in sys.modules]
+                timings.append((", ".join(loaded) or name, len(child_times),
+                                elapsed, elapsed - children))
+
+    builtins.__import__ = timed_import
+    try:
+        importlib.import_module(module_name)
+    finally:
+        builtins.__import__ = original_import
+    return timings
+
+
+def print_report(timings, limit=20):
+    """
+    Print the slowest imports from `profile_imports()`.
+
+    Parameters
+    ----------
+    timings : list of tuple
+        The result of `profile_imports()`.
+    limit : int
+        Number of modules to print, slowest first by cumulative time.
+    """
+    print("{0:>10} {1:>10}  {2}".format("cumul (ms)", "self (ms)", "module"))
+    for name, depth, cumulative, own in sorted(
+            timings, key=lambda timing: timing[2], reverse=True)[:limit]:
+        print("{0:10.1f} {1:10.1f}  {2}{3}".format(
+              cumulative * 1000, own * 1000, "  " * depth, name))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Time the imports of a module.")
+    argparser.add_argument("module", help="module to import, e.g. wsgi")
+    argparser.add_argument("--limit", type=int, default=20,
+                           help="number of modules to show (default: 20)")
+    args = argparser.parse_args()
+    started = time.time()
+    results = profile_imports(args.module)
+    print("Imported {0} in {1:.1f} ms.".format(
+          args.module, (time.time() - started) * 1000))
+    print_report(results, args.limit)
@@ -0,0 +1,236 @@
+"""Background jobs for queries that take too long to answer within a single
+request.
+
+A job is submitted and immediately given an id. It runs on a worker thread,
+and its result is kept for a limited time so the client can poll for it.
+Submitting a query identical to one that is queued, running or finished
+returns the existing job instead of starting another one.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from core.utilities import QueriesCancelled, QueryGroup
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobCancelled(QueriesCancelled):
+    """Raised when a query of a job is started after the job is cancelled."""
+
+
+class Job(object):
+    """
+    A query submitted to run in the background.
+
+    Attributes
+    ----------
+    id : str, unicode
+        Unique id of the job.
+    key : str, unicode
+        Normalized form of the spec, used to deduplicate jobs.
+    spec : dict
+        The validated query the job runs.
+    status : str, unicode
+        One of PENDING, RUNNING, DONE, FAILED or CANCELLED.
+    result : object
+        The result once the job is DONE.
+    error : str, unicode
+        The error message if the job FAILED.
+    queries : core.utilities.QueryGroup
+        The DB connections the job's query is running on, one per shard,
+        added by the run function so the query can be cancelled.
+    """
+
+    def __init__(self, spec):
+        self.id = uuid.uuid4().hex
+        self.key = json.dumps(spec, sort_keys=True)
+        self.spec = spec
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.queries = QueryGroup(error=JobCancelled)
+        self.future = None
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def cancelled(self):
+        return self.status == CANCELLED
+
+    def to_dict(self, with_result=True):
+        """
+        Describe the job, e.g. for a JSON response.
+
+        Parameters
+        ----------
+        with_result : bool
+            Whether to include the result of a finished job.
+
+        Returns
+        -------
+        dict
+        """
+        out = {
+            'id': self.id,
+            'spec': self.spec,
+            'status': self.status,
+            'created': self.created,
+            'finished': self.finished,
+        }
+        if self.error is not None:
+            out['error'] = self.error
+        if with_result and self.status == DONE:
+            out['result'] = self.result
+        return out
+
+
+class JobManager(object):
+    """
+    Runs jobs on a thread pool and keeps them until their TTL expires.
+
+    Parameters
+    ----------
+    run : callable
+        Called with a Job on a worker thread to compute its result. It should
+        run each query inside `job.queries.running_on()`, which raises
+        JobCancelled once the job is cancelled.
+    workers : int
+        Number of jobs that may run at once.
+    ttl : float
+        Seconds a finished job and its result are kept.
+    """
+
+    def __init__(self, run, workers, ttl):
+        self._run = run
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._ttl = ttl
+        self._jobs = {}
+        self._jobs_by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, spec):
+        """
+        Submit a query to run, unless an identical one is queued, running or
+        has a result that hasn't expired.
+
+        Parameters
+        ----------
+        spec : dict
+            The validated query. It must be JSON serializable.
+
+        Returns
+        -------
+        (Job, bool)
+            The job and whether it was newly created.
+        """
+        with self._lock:
+            self._expire()
+            job = Job(spec)
+            existing = self._jobs_by_key.get(job.key)
+            if existing is not None and \
+                    existing.status in (PENDING, RUNNING, DONE):
+                return existing, False
+            self._jobs[job.id] = job
+            self._jobs_by_key[job.key] = job
+            job.future = self._executor.submit(self._execute, job)
+            return job, True
+
+    def get(self, job_id):
+        """
+        Get a job by id.
+
+        Returns
+        -------
+        Job or None
+            The job, or None if it doesn't exist or has expired.
+        """
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. A queued job won't run, and the query of a running job
+        is cancelled on the DB server.
+
+        Returns
+        -------
+        Job or None
+            The job, or None if it doesn't exist or has expired.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status not in (PENDING, RUNNING):
+                return job
+            job.status = CANCELLED
+            job.finished = time.time()
+            job.future.cancel()
+        job.queries.cancel()
+        return job
+
+    def forget_results(self):
+        """
+        Stop reusing the results of finished jobs, e.g. after the table is
+        reloaded, so an identical query runs again. Finished jobs can still be
+        fetched by id until they expire.
+        """
+        with self._lock:
+            for key, job in list(self._jobs_by_key.items()):
+                if job.status == DONE:
+                    del self._jobs_by_key[key]
+
+    def stats(self):
+        """Count the jobs in each status."""
+        with self._lock:
+            self._expire()
+            counts = dict((status, 0) for status in
+                          (PENDING, RUNNING, DONE, FAILED, CANCELLED))
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def _execute(self, job):
+        with self._lock:
+            if job.status != PENDING:
+                return
+            job.status = RUNNING
+        try:
+            result = self._run(job)
+        except Exception as e:
+            with self._lock:
+                if job.status == RUNNING:
+                    job.status = FAILED
+                    job.error = str(e)
+        else:
+            with self._lock:
+                if job.status == RUNNING:
+                    job.status = DONE
+                    job.result = result
+        finally:
+            with self._lock:
+                if job.finished is None:
+                    job.finished = time.time()
+
+    def _expire(self):
+        # Must be called with the lock held
+        now = time.time()
+        expired = [job for job in self._jobs.values()
+                   if job.finished is not None and
+                   now - job.finished > self._ttl]
+        for job in expired:
+            del self._jobs[job.id]
+            if self._jobs_by_key.get(job.key) is job:
+                del self._jobs_by_key[job.key]
@@ -0,0 +1,161 @@
+"""Tell the server's workers that the data loader has reloaded the table, with
+Postgres `LISTEN`/`NOTIFY`.
+
+The loader publishes a new data version on CHANNEL when it finishes, and
+stores it in VERSION_TABLE. Each worker listens on a background thread and
+drops its caches as soon as the notification arrives, so requests never have
+to check the version. Whenever the listener connects, it also compares the
+stored version with the one its caches were filled from, so a worker forked
+with stale caches, or one that missed a notification, catches up.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+CHANNEL = 'medicare_data_version'
+
+# Table holding the latest published version, in a single row
+VERSION_TABLE = 'medicare_data_version'
+
+
+def publish(cur, version, channel=CHANNEL):
+    """
+    Publish a new data version, storing it in VERSION_TABLE. Listeners are
+    notified when the cursor's transaction commits.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        A cursor on the database the listeners are connected to.
+    version : str, unicode
+        The new version, e.g. the time the load finished.
+    channel : str, unicode
+        The channel to notify.
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS {0} (version TEXT NOT NULL, "
+                "published TIMESTAMP NOT NULL DEFAULT now());".format(
+                    VERSION_TABLE))
+    cur.execute("DELETE FROM {0};".format(VERSION_TABLE))
+    cur.execute("INSERT INTO {0} (version) VALUES (%s);".format(VERSION_TABLE),
+                (version, ))
+    cur.execute("SELECT pg_notify(%s, %s);", (channel, version))
+
+
+def current_version(cur):
+    """
+    Get the latest published data version.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        A cursor on the database the loader publishes to.
+
+    Returns
+    -------
+    str, unicode or None
+        The version, or None if none was ever published. If VERSION_TABLE
+        doesn't exist, the cursor's transaction is left aborted.
+    """
+    try:
+        cur.execute("SELECT version FROM {0};".format(VERSION_TABLE))
+    except psycopg2.ProgrammingError:
+        # The table was loaded before versions were stored
+        return None
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+class DataVersionListener(object):
+    """
+    Listens for new data versions on a background thread.
+
+    Each time the listener connects, including the first, it reads the
+    stored version, and calls the callback if it differs from the version it
+    has. That covers the notifications sent while it wasn't connected.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database the loader publishes to. Notifications aren't
+        sent to replicas, so it must be the primary.
+    on_change : callable
+        Called on the listening thread with each new version.
+    version : str, unicode, optional
+        The version the caller's data is from, e.g. read with
+        `current_version()` before its caches were filled. None if unknown.
+    channel : str, unicode
+        The channel to listen on.
+    retry_interval : float
+        Seconds to wait before reconnecting after the connection is lost.
+    """
+
+    def __init__(self, dsn, on_change, version=None, channel=CHANNEL,
+                 retry_interval=5):
+        self.dsn = dsn
+        self.on_change = on_change
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.version = version
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start listening."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='data_version_listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening, within a second."""
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                con = psycopg2.connect(dsn=self.dsn)
+            except psycopg2.Error:
+                self._stopped.wait(self.retry_interval)
+                continue
+            try:
+                con.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = con.cursor()
+                cur.execute("LISTEN {0};".format(self.channel))
+                # Read the version only once listening, so no publish is
+                # missed in between
+                version = current_version(cur)
+                if version != self.version:
+                    self._changed(version)
+                self._listen(con)
+            except (psycopg2.Error, select.error, EnvironmentError):
+                self._stopped.wait(self.retry_interval)
+            finally:
+                con.close()
+
+    def _listen(self, con):
+        while not self._stopped.is_set():
+            # Wake up every second to notice `stop()`
+            if select.select([con], [], [], 1) == ([], [], []):
+                continue
+            con.poll()
+            while con.notifies:
+                notify = con.notifies.pop(0)
+                if notify.channel == self.channel and \
+                        notify.payload != self.version:
+                    self._changed(notify.payload)
+
+    def _changed(self, version):
+        self.version = version
+        try:
+            self.on_change(version)
+        except Exception:
+            # Keep listening; the next notification gets another try
+            pass
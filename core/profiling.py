@@ -0,0 +1,238 @@
+"""Sampled profiling of the queries run by the server, to find the query shapes
+that are slow in Postgres and why.
+
+A sampled fraction of requests has its query run again with
+`EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` on a background thread, so the
+request itself isn't slowed down and results served from the cache are
+profiled too. The profiler keeps, for each query shape, the number of
+samples, their timings, buffer hits and reads and the tables they scanned
+sequentially, plus the full plans of the slowest samples.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _plan_nodes(node):
+    """Yield a plan node and all of its descendants."""
+    yield node
+    for child in node.get('Plans', ()):
+        for descendant in _plan_nodes(child):
+            yield descendant
+
+
+def summarize_plan(explained):
+    """
+    Extract the timings and buffer statistics of an `EXPLAIN (ANALYZE,
+    BUFFERS, FORMAT JSON)` result.
+
+    Parameters
+    ----------
+    explained : list or str, unicode
+        The single value returned by the EXPLAIN, as decoded JSON or as text.
+
+    Returns
+    -------
+    dict
+        The planning and execution time (milliseconds), the shared buffers
+        hit and read, the temp buffers read and written, the tables scanned
+        sequentially and the plan itself.
+    """
+    if not isinstance(explained, list):
+        explained = json.loads(explained)
+    top = explained[0]
+    plan = top['Plan']
+    seq_scans = sorted(set(node['Relation Name']
+                           for node in _plan_nodes(plan)
+                           if node['Node Type'] == 'Seq Scan'))
+    return {
+        'planning_ms': top.get('Planning Time', 0.0),
+        # Postgres before 9.4 calls the execution time the total runtime
+        'execution_ms': top.get('Execution Time',
+                                top.get('Total Runtime', 0.0)),
+        'shared_hit': plan.get('Shared Hit Blocks', 0),
+        'shared_read': plan.get('Shared Read Blocks', 0),
+        'temp_read': plan.get('Temp Read Blocks', 0),
+        'temp_written': plan.get('Temp Written Blocks', 0),
+        'seq_scans': seq_scans,
+        'plan': plan,
+    }
+
+
+class _ShapeStats(object):
+    """The totals of the samples of one query shape."""
+
+    def __init__(self, statement):
+        self.endpoint = statement.endpoint
+        self.col = statement.col
+        self.sql = statement.sql
+        self.samples = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.shared_hit = 0
+        self.shared_read = 0
+        self.temp_read = 0
+        self.temp_written = 0
+        self.seq_scans = set()
+        self.last_plan = None
+
+    def add(self, summary):
+        self.samples += 1
+        self.total_ms += summary['execution_ms']
+        self.max_ms = max(self.max_ms, summary['execution_ms'])
+        self.shared_hit += summary['shared_hit']
+        self.shared_read += summary['shared_read']
+        self.temp_read += summary['temp_read']
+        self.temp_written += summary['temp_written']
+        self.seq_scans.update(summary['seq_scans'])
+        self.last_plan = summary['plan']
+
+    def to_dict(self):
+        blocks = self.shared_hit + self.shared_read
+        return {
+            'endpoint': self.endpoint,
+            'col': self.col,
+            'sql': self.sql,
+            'samples': self.samples,
+            'mean_ms': round(self.total_ms / self.samples, 3),
+            'max_ms': round(self.max_ms, 3),
+            'shared_hit': self.shared_hit,
+            'shared_read': self.shared_read,
+            'hit_ratio': round(self.shared_hit / blocks, 4) if blocks
+            else None,
+            'temp_read': self.temp_read,
+            'temp_written': self.temp_written,
+            'seq_scans': sorted(self.seq_scans),
+            'last_plan': self.last_plan,
+        }
+
+
+class QueryProfiler(object):
+    """
+    Collects EXPLAIN ANALYZE profiles of a sampled fraction of queries.
+
+    Parameters
+    ----------
+    sample_rate : float
+        Fraction of requests to profile, from 0 (off) to 1.
+    capacity : int
+        Number of the slowest profiles whose full plans are kept.
+    max_pending : int
+        Most profiles that may wait to run at once; requests sampled while
+        that many are waiting aren't profiled, so profiling can't pile up
+        queries on a busy database.
+    """
+
+    def __init__(self, sample_rate=0.0, capacity=50, max_pending=4):
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.max_pending = max_pending
+        self._shapes = {}
+        # Min-heap of (execution_ms, sequence, profile), so the fastest of
+        # the kept profiles is the one replaced
+        self._slowest = []
+        self._sequence = itertools.count()
+        self._pending = 0
+        self._failed = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def enabled(self):
+        """Whether any requests are profiled."""
+        return self.sample_rate > 0
+
+    def sample(self, statement, explain):
+        """
+        Profile a statement in the background if this request is sampled.
+
+        Parameters
+        ----------
+        statement : core.statements.Statement
+            The statement the request runs.
+        explain : callable
+            Called with no arguments on the profiling thread, it runs the
+            statement with EXPLAIN ANALYZE and returns one EXPLAIN result per
+            shard, see `summarize_plan()`.
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._dropped += 1
+                return
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+        self._executor.submit(self._profile, statement, explain)
+
+    def _profile(self, statement, explain):
+        try:
+            results = explain()
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                self._failed += 1
+            return
+        summaries = [summarize_plan(result) for result in results]
+        with self._lock:
+            self._pending -= 1
+            stats = self._shapes.get(statement.name)
+            if stats is None:
+                stats = self._shapes[statement.name] = _ShapeStats(statement)
+            for shard, summary in enumerate(summaries):
+                stats.add(summary)
+                profile = dict(summary, shape=statement.name, shard=shard,
+                               endpoint=statement.endpoint,
+                               col=statement.col, recorded=time.time())
+                entry = (summary['execution_ms'], next(self._sequence),
+                         profile)
+                if len(self._slowest) < self.capacity:
+                    heapq.heappush(self._slowest, entry)
+                elif entry[0] > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def report(self):
+        """
+        Get the profiles collected so far.
+
+        Returns
+        -------
+        dict
+            The totals of each query shape, slowest mean first, and the
+            slowest profiles with their plans, slowest first.
+        """
+        with self._lock:
+            shapes = [dict(stats.to_dict(), shape=name)
+                      for name, stats in self._shapes.items()]
+            slowest = [profile for _, _, profile in
+                       sorted(self._slowest, key=lambda e: e[:2],
+                              reverse=True)]
+            return {
+                'sample_rate': self.sample_rate,
+                'pending': self._pending,
+                'failed': self._failed,
+                'dropped': self._dropped,
+                'shapes': sorted(shapes, key=lambda s: s['mean_ms'],
+                                 reverse=True),
+                'slowest': slowest,
+            }
+
+    def reset(self):
+        """Drop the profiles collected so far."""
+        with self._lock:
+            self._shapes.clear()
+            self._slowest = []
+            self._failed = 0
+            self._dropped = 0
@@ -0,0 +1,243 @@
+"""Route read-only queries across read replicas of the database.
+
+Each database node has its own connection pool. Reads are spread round-robin
+over the replicas that passed their last health check, and fall back to the
+primary when there are no healthy replicas. A background thread re-checks
+every node periodically so failed nodes are taken out of rotation and
+recovered ones are put back.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from core.utilities import connection_pool, pooled_cursor
+
+
+def make_dsn(host, dbname, user, password=None):
+    """
+    Make the DSN of a database.
+
+    Parameters
+    ----------
+    host : str, unicode
+        Host of the database, optionally with a port, e.g. 'localhost:5433'.
+    dbname : str, unicode
+        Name of the database.
+    user : str, unicode
+        User to connect as.
+    password : str, unicode, optional
+        Password of the user, if one is needed.
+
+    Returns
+    -------
+    str, unicode
+        A DSN that can be passed to `psycopg2.connect()`.
+    """
+    parts = []
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        parts.append("port={0}".format(port))
+    parts = ["host={0}".format(host)] + parts + [
+        "dbname={0}".format(dbname), "user={0}".format(user)]
+    if password is not None:
+        parts.append("password={0}".format(password))
+    return " ".join(parts)
+
+
+class DatabaseNode(object):
+    """
+    A database server, its connection pool and its health.
+
+    The pool is created on first use, so a node that is down when the server
+    starts doesn't stop the others from being used.
+    """
+
+    def __init__(self, dsn, minconn, maxconn):
+        self.dsn = dsn
+        self.healthy = True
+        self.last_checked = None
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = connection_pool(self.dsn, self._minconn,
+                                             self._maxconn)
+            return self._pool
+
+    def check(self, timeout=2):
+        """
+        Check the node is accepting queries, and record the result.
+
+        Returns
+        -------
+        bool
+            Whether the node is healthy.
+        """
+        try:
+            con = psycopg2.connect(dsn=self.dsn, connect_timeout=timeout)
+            try:
+                cur = con.cursor()
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                con.close()
+        except psycopg2.Error:
+            self.healthy = False
+        else:
+            self.healthy = True
+        self.last_checked = time.time()
+        return self.healthy
+
+    def close(self):
+        """Close every connection in the node's pool."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+class ReplicaRouter(object):
+    """
+    Spreads reads over a primary database's replicas.
+
+    Parameters
+    ----------
+    primary_dsn : str, unicode
+        DSN of the primary, which takes reads when no replica is healthy.
+    replica_dsns : list of str, unicode
+        DSNs of the read replicas.
+    minconn : int
+        Connections each node's pool opens up front.
+    maxconn : int
+        Maximum number of connections in each node's pool.
+    """
+
+    def __init__(self, primary_dsn, replica_dsns, minconn, maxconn):
+        self.primary = DatabaseNode(primary_dsn, minconn, maxconn)
+        self.replicas = [DatabaseNode(dsn, minconn, maxconn)
+                         for dsn in replica_dsns]
+        self._counter = itertools.count()
+        self._health_thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def nodes(self):
+        return [self.primary] + self.replicas
+
+    def pick(self):
+        """
+        Pick the node to send the next read to.
+
+        Returns
+        -------
+        DatabaseNode
+            The next healthy replica in turn, or the primary if there are
+            none.
+        """
+        healthy = [node for node in self.replicas if node.healthy]
+        if not healthy:
+            return self.primary
+        return healthy[next(self._counter) % len(healthy)]
+
+    def _borrow(self):
+        # Try the picked node first, then every other node, so a node that
+        # went down since its last health check doesn't fail the request
+        first = self.pick()
+        candidates = [first] + [node for node in self.nodes
+                                if node is not first and node.healthy]
+        error = None
+        for node in candidates:
+            try:
+                return node, node.pool.getconn()
+            except psycopg2.OperationalError as e:
+                node.healthy = False
+                error = e
+        raise error
+
+    @contextmanager
+    def read_cursor(self, cursor_factory=None):
+        """
+        Borrow a connection for read-only queries and yield a cursor on it.
+
+        Parameters
+        ----------
+        cursor_factory : psycopg2.extras
+            An optional psycopg2 cursor type, e.g. DictCursor.
+
+        Yields
+        ------
+        psycopg2.extensions.cursor
+            A cursor on a replica, or on the primary if no replica is healthy.
+        """
+        node, con = self._borrow()
+        try:
+            with pooled_cursor(node.pool, cursor_factory, con=con) as cur:
+                yield cur
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            node.healthy = False
+            raise
+
+    def check_health(self):
+        """Check every node now."""
+        for node in self.nodes:
+            node.check()
+
+    def start_health_checks(self, interval):
+        """
+        Start a daemon thread that checks every node each `interval` seconds.
+        Does nothing if the thread is already running.
+        """
+        if self._health_thread is not None and self._health_thread.is_alive():
+            return
+
+        def run():
+            while not self._stopped.wait(interval):
+                self.check_health()
+
+        self._health_thread = threading.Thread(target=run)
+        self._health_thread.daemon = True
+        self._health_thread.start()
+
+    def status(self):
+        """
+        Describe the health of every node.
+
+        Returns
+        -------
+        list of dict
+            The role, host and health of each node.
+        """
+        out = []
+        for node in self.nodes:
+            host = dict(part.split('=', 1) for part in node.dsn.split()
+                        if part.startswith(('host=', 'port=')))
+            out.append({
+                'role': 'primary' if node is self.primary else 'replica',
+                'host': host.get('host'),
+                'port': host.get('port'),
+                'healthy': node.healthy,
+                'last_checked': node.last_checked,
+            })
+        return out
+
+    def close(self):
+        """Stop the health checks and close every node's connection pool."""
+        self._stopped.set()
+        for node in self.nodes:
+            node.close()
@@ -0,0 +1,202 @@
+"""Hash sharding of the beneficiary table across several databases, and
+merging of partial aggregates computed on each shard.
+
+Rows are assigned to shards by a CRC32 hash of their `id`, so the data loader
+and anything else that needs to find a row's shard agree on it. Queries are
+scattered to every shard in parallel, and each shard returns an aggregate that
+can be combined exactly: counts are summed, averages are computed from sums
+and counts, and frequencies from per-state numerators and denominators.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import zlib
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def shard_for(row_id, num_shards):
+    """
+    Get the shard a row belongs to.
+
+    Parameters
+    ----------
+    row_id : str, bytes
+        The row's `id`.
+    num_shards : int
+        Number of shards.
+
+    Returns
+    -------
+    int
+        Index of the shard, from 0 to `num_shards` - 1.
+    """
+    if not isinstance(row_id, bytes):
+        row_id = row_id.encode('ascii')
+    return (zlib.crc32(row_id) & 0xffffffff) % num_shards
+
+
+class ShardSet(object):
+    """
+    The shards of the table, each reached through its own
+    `core.routing.ReplicaRouter`. An unsharded table is a set of one shard.
+
+    Parameters
+    ----------
+    routers : list of core.routing.ReplicaRouter
+        The router of each shard, in shard order.
+    concurrency : int
+        Number of `scatter()` calls, e.g. from different request threads,
+        that may run at once without queueing behind each other. There is
+        no point in it being more than the size of a router's pool.
+    """
+
+    def __init__(self, routers, concurrency=1):
+        self.routers = routers
+        self._executor = None
+        if len(routers) > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(routers) * concurrency)
+
+    def scatter(self, func):
+        """
+        Call a function with the router of every shard, in parallel.
+
+        Parameters
+        ----------
+        func : callable
+            Called with each shard's router.
+
+        Returns
+        -------
+        list
+            The result of each call, in shard order.
+        """
+        if self._executor is None:
+            return [func(router) for router in self.routers]
+        futures = [self._executor.submit(func, router)
+                   for router in self.routers]
+        return [future.result() for future in futures]
+
+    def status(self):
+        """Describe the health of every node of every shard."""
+        out = []
+        for i, router in enumerate(self.routers):
+            for node in router.status():
+                node['shard'] = i
+                out.append(node)
+        return out
+
+    def close(self):
+        """Close the connection pools of every shard."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for router in self.routers:
+            router.close()
+
+
+def merge_total(partials):
+    """
+    Sum single-value results, e.g. of COUNT(*).
+
+    Parameters
+    ----------
+    partials : list of list of tuple
+        The rows returned by each shard.
+
+    Returns
+    -------
+    list of tuple
+        A single row holding the total.
+    """
+    return [(sum(rows[0][0] for rows in partials), )]
+
+
+def merge_counts(partials):
+    """
+    Sum the counts of groups, e.g. of a `GROUP BY ... COUNT(*)` query.
+
+    Parameters
+    ----------
+    partials : list of list of tuple
+        The rows returned by each shard. The last value of each row is the
+        count and the others are the group's key.
+
+    Returns
+    -------
+    list of tuple
+        One row per group with the same layout, in order of first appearance.
+    """
+    totals = OrderedDict()
+    for rows in partials:
+        for row in rows:
+            key = tuple(row[:-1])
+            totals[key] = totals.get(key, 0) + row[-1]
+    return [key + (num, ) for key, num in totals.items()]
+
+
+def merge_average(partials):
+    """
+    Compute an average from the (sum, count) row returned by each shard.
+
+    Returns
+    -------
+    list of tuple
+        A single row holding the average, or None if every value is NULL.
+    """
+    total = sum(rows[0][0] or 0 for rows in partials)
+    num = sum(rows[0][1] for rows in partials)
+    return [(total / num if num else None, )]
+
+
+def merge_frequency(partials):
+    """
+    Compute the frequency of a disease in each state from the
+    (state, claims, cases) rows returned by each shard.
+
+    Returns
+    -------
+    list of tuple
+        (state, frequency) rows, in descending order of frequency.
+    """
+    claims = {}
+    cases = {}
+    for rows in partials:
+        for state, num_claims, num_cases in rows:
+            claims[state] = claims.get(state, 0) + num_claims
+            cases[state] = cases.get(state, 0) + num_cases
+    freqs = [(state, cases[state] / claims[state]) for state in claims]
+    return sorted(freqs, key=lambda row: row[1], reverse=True)
+
+
+def merge_sums(partials, keys=1):
+    """
+    Sum the rows of each group column by column, e.g. rollup rows of the same
+    state from several shards.
+
+    Parameters
+    ----------
+    partials : list of list of tuple
+        The rows returned by each shard. The first `keys` values of each row
+        are the group's key and the others are summed.
+    keys : int
+        Number of values in the key.
+
+    Returns
+    -------
+    list of tuple
+        One row per group with the same layout, in order of first appearance.
+    """
+    totals = OrderedDict()
+    for rows in partials:
+        for row in rows:
+            key = tuple(row[:keys])
+            if key in totals:
+                totals[key] = [total + val
+                               for total, val in zip(totals[key], row[keys:])]
+            else:
+                totals[key] = list(row[keys:])
+    return [key + tuple(values) for key, values in totals.items()]
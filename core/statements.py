@@ -0,0 +1,148 @@
+"""Registry of the fixed query shapes used by the server, prepared once per
+database connection and then executed by name.
+
+Every endpoint runs one query per allowed column, so the full set of query
+shapes is known up front. Registering them validates the column names once,
+and executing them with `EXECUTE` skips parsing and planning the query on
+every request.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+def _concatenate(partials):
+    return [row for rows in partials for row in rows]
+
+
+class Statement(object):
+    """
+    A named query shape.
+
+    Attributes
+    ----------
+    name : str, unicode
+        Name the query is prepared under, unique within a registry.
+    sql : str, unicode
+        The query, with `$1`, `$2`, ... placeholders for any parameters.
+    endpoint : str, unicode
+        The endpoint the query belongs to.
+    col : str, unicode or None
+        The column the query was built for, if any.
+    merge : callable
+        Combines the rows returned by each shard into the final result, see
+        `core.sharding`.
+    names : tuple of str, unicode
+        Names of the columns of the merged result.
+    """
+
+    def __init__(self, name, sql, endpoint, col, merge, names):
+        self.name = name
+        self.sql = sql
+        self.endpoint = endpoint
+        self.col = col
+        self.merge = merge
+        self.names = names
+
+
+class StatementRegistry(object):
+    """
+    The query shapes of each endpoint, keyed by the column they were built
+    for.
+    """
+
+    def __init__(self):
+        self._statements = {}
+
+    def register(self, endpoint, build_sql, columns=(None, ), merge=None,
+                 names=None):
+        """
+        Register the query shapes of an endpoint.
+
+        Parameters
+        ----------
+        endpoint : str, unicode
+            Name of the endpoint.
+        build_sql : callable
+            Called with each allowed column to build its query.
+        columns : sequence of str, unicode
+            The columns the endpoint allows. Endpoints that don't take a
+            column have a single shape, registered under None.
+        merge : callable
+            Combines the rows returned by each shard. Defaults to
+            concatenating them.
+        names : callable
+            Called with each allowed column to get the names of the columns
+            of the merged result.
+        """
+        if merge is None:
+            merge = _concatenate
+        for col in columns:
+            name = endpoint if col is None else '{0}__{1}'.format(endpoint,
+                                                                  col)
+            self._statements[(endpoint, col)] = Statement(
+                name, build_sql(col), endpoint, col, merge,
+                tuple(names(col)) if names else ())
+
+    def get(self, endpoint, col=None):
+        """
+        Get the query shape of an endpoint for a column.
+
+        Returns
+        -------
+        Statement or None
+            The statement, or None if the column isn't allowed.
+        """
+        return self._statements.get((endpoint, col))
+
+    def columns(self, endpoint):
+        """
+        Get the columns allowed by an endpoint.
+
+        Returns
+        -------
+        list of str, unicode
+        """
+        return sorted(col for (name, col) in self._statements
+                      if name == endpoint and col is not None)
+
+    def execute(self, cur, statement, params=()):
+        """
+        Execute a statement, preparing it first if this is the first time it
+        runs on the cursor's connection.
+
+        Parameters
+        ----------
+        cur : psycopg2.extensions.cursor
+            A cursor on a connection created with
+            `core.utilities.PreparedConnection`.
+        statement : Statement
+            The statement to execute.
+        params : tuple
+            Values for the statement's `$n` placeholders.
+        """
+        self._execute(cur, statement, params, "")
+
+    def explain(self, cur, statement, params=()):
+        """
+        Execute a statement with `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)`,
+        preparing it first if needed, so the plan is the one its requests
+        use. The cursor then holds a single row with the EXPLAIN result,
+        see `core.profiling.summarize_plan()`.
+        """
+        self._execute(cur, statement, params,
+                      "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ")
+
+    def _execute(self, cur, statement, params, prefix):
+        con = cur.connection
+        if statement.name not in con.prepared:
+            cur.execute("PREPARE {0} AS {1}".format(statement.name,
+                                                    statement.sql))
+            con.prepared.add(statement.name)
+        if params:
+            placeholders = ", ".join(["%s"] * len(params))
+            cur.execute("{0}EXECUTE {1} ({2})".format(
+                prefix, statement.name, placeholders), params)
+        else:
+            cur.execute("{0}EXECUTE {1}".format(prefix, statement.name))
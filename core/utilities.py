@@ -4,10 +4,15 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import threading
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 
 
-def cursor_connect(db_dsn, cursor_factory=None):
+def cursor_connect(db_dsn, cursor_factory=None, name=None):
     """
     Connects to the DB and returns the connection and cursor, ready to use.
 
@@ -17,6 +22,10 @@ def cursor_connect(db_dsn, cursor_factory=None):
         DSN of the database to connect to.
     cursor_factory : psycopg2.extras
         An optional psycopg2 cursor type, e.g. DictCursor.
+    name : str, unicode
+        An optional cursor name. Named cursors are server-side cursors, which
+        fetch rows from the DB in batches of `cursor.itersize` rows instead of
+        all at once.
 
     Returns
     -------
@@ -25,7 +34,160 @@ def cursor_connect(db_dsn, cursor_factory=None):
     """
     con = psycopg2.connect(dsn=db_dsn)
     if not cursor_factory:
-        cur = con.cursor()
+        cur = con.cursor(name=name)
     else:
-        cur = con.cursor(cursor_factory=cursor_factory)
+        cur = con.cursor(name=name, cursor_factory=cursor_factory)
     return con, cur
+
+
+class QueriesCancelled(Exception):
+    """Raised when a query is started in a group that was already cancelled."""
+
+
+class QueryGroup(object):
+    """
+    The connections a group of queries is running on, so they can all be
+    cancelled at once, e.g. the per-shard queries of a job.
+
+    A connection is only in the group while a query of the group is running
+    on it. It must be removed before it goes back to its pool, so that a
+    cancel never reaches a query of another request that borrowed it since.
+
+    Parameters
+    ----------
+    error : type
+        The exception raised by `add()` once the group is cancelled.
+    """
+
+    def __init__(self, error=QueriesCancelled):
+        self.error = error
+        self.cancelled = False
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def add(self, con):
+        """
+        Add a connection that is about to run a query of the group.
+
+        Raises
+        ------
+        QueriesCancelled
+            Or the group's `error`, if the group was cancelled.
+        """
+        with self._lock:
+            if self.cancelled:
+                raise self.error()
+            self._connections.append(con)
+
+    def discard(self, con):
+        """
+        Remove a connection once its query is over. Waits for a cancel in
+        progress, so the connection can be reused safely once this returns.
+        """
+        with self._lock:
+            if con in self._connections:
+                self._connections.remove(con)
+
+    @contextmanager
+    def running_on(self, con):
+        """Keep a connection in the group while the block runs."""
+        self.add(con)
+        try:
+            yield con
+        finally:
+            self.discard(con)
+
+    def cancel(self):
+        """
+        Cancel the queries running on the group's connections, and any that
+        the group starts later.
+        """
+        with self._lock:
+            self.cancelled = True
+            for con in self._connections:
+                try:
+                    con.cancel()
+                except psycopg2.Error:
+                    # The connection is broken, so its query is over anyway
+                    pass
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    A connection that keeps track of the statements prepared on it, which
+    last as long as the connection does.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparedConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def connection_pool(db_dsn, minconn, maxconn):
+    """
+    Make a thread-safe pool of connections to the DB.
+
+    Parameters
+    ----------
+    db_dsn : str, unicode
+        DSN of the database to connect to.
+    minconn : int
+        Number of connections opened up front.
+    maxconn : int
+        Maximum number of connections the pool will open.
+
+    Returns
+    -------
+    psycopg2.pool.ThreadedConnectionPool
+        A pool of `PreparedConnection` connections.
+    """
+    return psycopg2.pool.ThreadedConnectionPool(
+        minconn, maxconn, dsn=db_dsn, connection_factory=PreparedConnection)
+
+
+@contextmanager
+def pooled_cursor(pool, cursor_factory=None, con=None):
+    """
+    Borrow a connection from a pool and yield a cursor on it.
+
+    The connection's transaction is rolled back when the block exits, so the
+    pool should only be used for read-only queries. Connections that have
+    been broken are discarded rather than returned to the pool.
+
+    Parameters
+    ----------
+    pool : psycopg2.pool.AbstractConnectionPool
+        The pool to borrow a connection from.
+    cursor_factory : psycopg2.extras
+        An optional psycopg2 cursor type, e.g. DictCursor.
+    con : psycopg2.extensions.connection
+        A connection already borrowed from the pool, to use instead of
+        borrowing another one.
+
+    Yields
+    ------
+    psycopg2.extensions.cursor
+        A cursor on the borrowed connection.
+    """
+    if con is None:
+        con = pool.getconn()
+    broken = False
+    try:
+        if not cursor_factory:
+            cur = con.cursor()
+        else:
+            cur = con.cursor(cursor_factory=cursor_factory)
+        yield cur
+    except psycopg2.extensions.QueryCanceledError:
+        # The query was cancelled but the connection is still usable
+        raise
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if not broken and not con.closed:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(con, close=broken or bool(con.closed))
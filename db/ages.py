@@ -0,0 +1,137 @@
+"""Age and mortality rollup of the beneficiary table, built by the data loader.
+
+Each beneficiary's age on REFERENCE_DATE is put in an age band once, when
+the table is loaded, so no request does date arithmetic on the rows. The
+rollup has one row per state, sex and age band, holding the number of
+beneficiaries and deaths, overall and among those with each disease. At
+about 600 rows it is small enough to read whole, and the distribution by
+state, by sex or by any disease flag is summed from it.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from db import schema
+
+# Ages are computed on the last day of the year the data covers
+REFERENCE_DATE = '2010-12-31'
+
+# Lower bound of each age band, in years
+AGE_BANDS = (0, 65, 70, 75, 80, 85)
+
+# Columns the age bands can be broken down by
+BY_COLUMNS = ('state', 'sex') + schema.DISEASE_COLUMNS
+
+
+def age_table(table_name):
+    """Name of the age rollup of a table."""
+    return '{0}_age_rollup'.format(table_name)
+
+
+def band_label(lower):
+    """
+    Get the label of an age band, e.g. '65-69'.
+
+    Parameters
+    ----------
+    lower : int
+        The band's lower bound, from AGE_BANDS.
+
+    Returns
+    -------
+    str, unicode
+    """
+    i = AGE_BANDS.index(lower)
+    if i == 0:
+        return '<{0}'.format(AGE_BANDS[1])
+    if i == len(AGE_BANDS) - 1:
+        return '{0}+'.format(lower)
+    return '{0}-{1}'.format(lower, AGE_BANDS[i + 1] - 1)
+
+
+def create_sql(table_name):
+    """
+    Get the SQL that builds the age rollup from a loaded table, whose `dob`
+    and `dod` columns are DATEs.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        The table to roll up.
+
+    Returns
+    -------
+    list of str, unicode
+        Statements to execute in order.
+    """
+    ages = age_table(table_name)
+    band = "CASE {0} ELSE {1} END".format(
+        " ".join("WHEN years < {0} THEN {1}".format(upper, lower)
+                 for lower, upper in zip(AGE_BANDS, AGE_BANDS[1:])),
+        AGE_BANDS[-1])
+    deceased = "dod IS NOT NULL AND dod <= DATE '{0}'".format(REFERENCE_DATE)
+    aggregates = [
+        "COUNT(*) AS beneficiaries",
+        "SUM(CASE WHEN {0} THEN 1 ELSE 0 END)::bigint AS deaths".format(
+            deceased),
+    ]
+    for col in schema.DISEASE_COLUMNS:
+        aggregates.append(
+            "SUM(CASE WHEN {0} THEN 1 ELSE 0 END)::bigint AS {0}".format(col))
+        aggregates.append(
+            "SUM(CASE WHEN {0} AND {1} THEN 1 ELSE 0 END)::bigint "
+            "AS {0}_deaths".format(col, deceased))
+    return [
+        # The age is computed once per row, in the subquery
+        "CREATE TABLE {0} AS SELECT state, sex::text AS sex, "
+        "({1})::smallint AS age_band, {2} FROM (SELECT *, date_part('year', "
+        "age(DATE '{3}', dob)) AS years FROM {4} WHERE dob IS NOT NULL) t "
+        "GROUP BY 1, 2, 3;".format(ages, band, ", ".join(aggregates),
+                                   REFERENCE_DATE, table_name),
+        "ALTER TABLE {0} ADD PRIMARY KEY (state, sex, age_band);".format(ages),
+        "ANALYZE {0};".format(ages),
+    ]
+
+
+def drop_sql(table_name):
+    """
+    Get the SQL that drops the age rollup, if it exists.
+
+    Returns
+    -------
+    list of str, unicode
+    """
+    return ["DROP TABLE IF EXISTS {0};".format(age_table(table_name))]
+
+
+def bands_sql(table_name, by=None):
+    """
+    Query returning (group, age_band, beneficiaries, deaths) rows, where the
+    group is the value of the `by` column as text.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        The table whose rollup is read.
+    by : str, unicode, optional
+        A column in BY_COLUMNS to break the age bands down by. Without it
+        there is a single group, 'all'.
+
+    Returns
+    -------
+    str, unicode
+    """
+    ages = age_table(table_name)
+    if by is None:
+        return ("SELECT 'all', age_band, SUM(beneficiaries)::bigint, "
+                "SUM(deaths)::bigint FROM {0} GROUP BY 2".format(ages))
+    if by in schema.DISEASE_COLUMNS:
+        # Those without the disease are the rest of the beneficiaries
+        return ("SELECT 'true', age_band, SUM({0})::bigint, "
+                "SUM({0}_deaths)::bigint FROM {1} GROUP BY 2 UNION ALL "
+                "SELECT 'false', age_band, SUM(beneficiaries - {0})::bigint, "
+                "SUM(deaths - {0}_deaths)::bigint FROM {1} "
+                "GROUP BY 2".format(by, ages))
+    return ("SELECT {0}, age_band, SUM(beneficiaries)::bigint, "
+            "SUM(deaths)::bigint FROM {1} GROUP BY 1, 2".format(by, ages))
@@ -0,0 +1,120 @@
+"""Benchmark the transform stage of the data loader on synthetic data.
+
+Generates a CSV file shaped like the downloaded CMS beneficiary summary files,
+then times `data_loader.prep_csv()` on it with an increasing number of worker
+processes and prints the throughput and speedup of each run::
+
+    python db/bench_prep.py --rows 10000000 --workers 1,2,4,8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Need to append parent dir to path so you can import files in sister dirs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from db import data_loader
+
+
+def make_row(rand):
+    """
+    Make a random row in the format of the downloaded CSV files.
+
+    Parameters
+    ----------
+    rand : random.Random
+        The random number generator to use.
+
+    Returns
+    -------
+    list of str
+    """
+    dob = '19{0:02d}{1:02d}{2:02d}'.format(rand.randint(10, 89),
+                                           rand.randint(1, 12),
+                                           rand.randint(1, 28))
+    dod = '2010{0:02d}01'.format(rand.randint(1, 12)) \
+        if rand.random() < 0.02 else ''
+    row = [
+        '{0:016X}'.format(rand.getrandbits(64)),
+        dob,
+        dod,
+        rand.choice('12'),
+        rand.choice('1235'),
+        rand.choice('0Y'),
+        str(rand.randint(1, 54)),
+        str(rand.randint(0, 999)),
+    ]
+    row += [str(rand.choice((0, 12))) for _ in range(4)]
+    row += [rand.choice('12') for _ in range(11)]
+    row += ['{0:.2f}'.format(rand.choice((0, rand.randint(0, 5000) * 10)))
+            for _ in range(9)]
+    return [val.encode('ascii') for val in row]
+
+
+def make_input(path, num_rows, seed=0):
+    """Write `num_rows` random rows to a CSV file at `path`."""
+    rand = random.Random(seed)
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        for _ in range(num_rows):
+            writer.writerow(make_row(rand))
+
+
+def time_prep(path, workers, out_dir):
+    """
+    Time `prep_csv()` on a file, writing its output in `out_dir`.
+
+    Returns
+    -------
+    float
+        Seconds taken.
+    """
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        with open(path, 'rb') as f:
+            start = time.time()
+            filenames = data_loader.prep_csv(f, workers=workers)
+            elapsed = time.time() - start
+        for filename in filenames:
+            os.remove(filename)
+            os.remove(filename + '.profile.json')
+    finally:
+        os.chdir(cwd)
+    return elapsed
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the data loader's transform stage.")
+    argparser.add_argument("--rows", type=int, default=10000000,
+                           help="number of synthetic rows (default: 10M)")
+    argparser.add_argument("--workers", default="1,2,4,8",
+                           help="comma-separated worker counts to time")
+    args = argparser.parse_args()
+    worker_counts = [int(n) for n in args.workers.split(',')]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'synthetic.csv')
+        print("Generating {0:,} rows.".format(args.rows))
+        make_input(path, args.rows)
+        # Speedups are relative to the first worker count
+        baseline = None
+        for workers in worker_counts:
+            elapsed = time_prep(path, workers, tmp_dir)
+            if baseline is None:
+                baseline = elapsed
+            print("{0:>2} workers: {1:8.1f}s {2:>12,.0f} rows/s "
+                  "{3:5.2f}x".format(workers, elapsed, args.rows / elapsed,
+                                     baseline / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,304 @@
+"""Column profile of the beneficiary table, computed by the data loader as it
+transforms the rows and stored next to the table.
+
+For each part (downloaded data file) loaded into a database, the stats table
+holds every column's row and null counts, minimum and maximum, and the total
+of the numeric columns, and the value counts table holds the number of rows
+with each value of the categorical columns. They are written in the same
+transaction as the part's COPY, so they always describe exactly the rows in
+the table. The loader checks the table against them, and the server answers
+row counts, value counts and averages from them instead of scanning the
+table.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+
+from db import schema
+
+# Columns whose number of rows with each value is counted
+COUNTED_COLUMNS = tuple(
+    col for col, kind in schema.COLUMNS.items()
+    if kind in (schema.SEX, schema.RACE, schema.STATE, schema.BOOLEAN) or
+    col == 'county_code' or col.endswith('coverage_months'))
+
+# Columns whose values are totalled, for averages
+SUMMED_COLUMNS = tuple(col for col, kind in schema.COLUMNS.items()
+                       if kind == schema.INTEGER and col != 'county_code')
+
+# Types that value counts, stored as text, are cast back to
+_CASTS = {
+    schema.SEX: 'sex',
+    schema.RACE: 'race',
+    schema.STATE: 'varchar',
+    schema.BOOLEAN: 'boolean',
+    schema.INTEGER: 'int',
+}
+
+# (index, name, is integer, is counted, is summed) of each column of a row
+_LAYOUT = [(i, col, kind == schema.INTEGER, col in COUNTED_COLUMNS,
+            col in SUMMED_COLUMNS)
+           for i, (col, kind) in enumerate(schema.COLUMNS.items())]
+
+
+class ColumnProfile(object):
+    """
+    Statistics of the columns of a set of rows, which can be computed for
+    chunks of the rows separately and merged.
+
+    Attributes
+    ----------
+    num_rows : int
+        Number of rows.
+    nulls : dict
+        Number of empty (NULL) values of each column.
+    mins, maxs : dict
+        Smallest and largest value of each column with a non-NULL value, as
+        ints for integer columns and strings otherwise. Dates compare
+        correctly as YYYYMMDD strings.
+    totals : dict
+        Total of each of SUMMED_COLUMNS.
+    counts : dict
+        Number of rows with each non-NULL value, as a string, of each of
+        COUNTED_COLUMNS.
+    """
+
+    def __init__(self):
+        self.num_rows = 0
+        self.nulls = dict((col, 0) for col in schema.COLUMNS)
+        self.mins = {}
+        self.maxs = {}
+        self.totals = dict((col, 0) for col in SUMMED_COLUMNS)
+        self.counts = dict((col, {}) for col in COUNTED_COLUMNS)
+
+    def add(self, row):
+        """
+        Add a row, as transformed by `data_loader.transform_row()`.
+
+        Parameters
+        ----------
+        row : list of str
+            The row's values, in the order of `schema.COLUMNS`.
+        """
+        self.num_rows += 1
+        mins = self.mins
+        maxs = self.maxs
+        for i, col, is_integer, is_counted, is_summed in _LAYOUT:
+            value = row[i]
+            if value == b'':
+                self.nulls[col] += 1
+                continue
+            if is_integer:
+                value = int(value)
+                if is_summed:
+                    self.totals[col] += value
+            if col not in mins or value < mins[col]:
+                mins[col] = value
+            if col not in maxs or value > maxs[col]:
+                maxs[col] = value
+            if is_counted:
+                key = str(value) if is_integer else value.decode('ascii')
+                counts = self.counts[col]
+                counts[key] = counts.get(key, 0) + 1
+
+    def merge(self, other):
+        """Add the rows of another profile to this one."""
+        self.num_rows += other.num_rows
+        for col, num in other.nulls.items():
+            self.nulls[col] += num
+        for col, value in other.mins.items():
+            if col not in self.mins or value < self.mins[col]:
+                self.mins[col] = value
+        for col, value in other.maxs.items():
+            if col not in self.maxs or value > self.maxs[col]:
+                self.maxs[col] = value
+        for col, total in other.totals.items():
+            self.totals[col] += total
+        for col, counts in other.counts.items():
+            mine = self.counts[col]
+            for value, num in counts.items():
+                mine[value] = mine.get(value, 0) + num
+
+    def _text(self, value):
+        return value.decode('ascii') if isinstance(value, bytes) else value
+
+    def dump(self, path):
+        """
+        Write the profile to a JSON file, which only appears once it is
+        complete.
+        """
+        data = {
+            'num_rows': self.num_rows,
+            'nulls': self.nulls,
+            'mins': dict((col, self._text(value))
+                         for col, value in self.mins.items()),
+            'maxs': dict((col, self._text(value))
+                         for col, value in self.maxs.items()),
+            'totals': self.totals,
+            'counts': self.counts,
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a profile written by `dump()`."""
+        with open(path) as f:
+            data = json.load(f)
+        profile = cls()
+        for name, value in data.items():
+            setattr(profile, name, value)
+        return profile
+
+
+def stats_table(table_name):
+    """Name of the column stats table of a table."""
+    return '{0}_column_stats'.format(table_name)
+
+
+def counts_table(table_name):
+    """Name of the value counts table of a table."""
+    return '{0}_value_counts'.format(table_name)
+
+
+def create_sql(table_name):
+    """
+    Get the SQL that creates the stats tables, if they don't exist.
+
+    Returns
+    -------
+    list of str, unicode
+    """
+    stats = stats_table(table_name)
+    counts = counts_table(table_name)
+    return [
+        "CREATE TABLE IF NOT EXISTS {0} (part VARCHAR(128), col VARCHAR(64), "
+        "num_rows BIGINT NOT NULL, nulls BIGINT NOT NULL, min_value TEXT, "
+        "max_value TEXT, total BIGINT, PRIMARY KEY (part, col));".format(
+            stats),
+        "CREATE TABLE IF NOT EXISTS {0} (part VARCHAR(128) NOT NULL, "
+        "col VARCHAR(64) NOT NULL, value TEXT, "
+        "num BIGINT NOT NULL);".format(counts),
+    ]
+
+
+def drop_sql(table_name):
+    """
+    Get the SQL that drops the stats tables, if they exist.
+
+    Returns
+    -------
+    list of str, unicode
+    """
+    return ["DROP TABLE IF EXISTS {0};".format(stats_table(table_name)),
+            "DROP TABLE IF EXISTS {0};".format(counts_table(table_name))]
+
+
+def save(cur, table_name, part, profile):
+    """
+    Store the profile of a part's rows, in the cursor's transaction,
+    replacing any stored before.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        A cursor on the database the part is loaded into.
+    table_name : str, unicode
+        The table being loaded.
+    part : str, unicode
+        Name of the part.
+    profile : ColumnProfile
+        The profile of the part's rows in this database.
+    """
+    stats = stats_table(table_name)
+    counts = counts_table(table_name)
+    cur.execute("DELETE FROM {0} WHERE part = %s;".format(stats), (part, ))
+    cur.execute("DELETE FROM {0} WHERE part = %s;".format(counts), (part, ))
+    cur.executemany(
+        "INSERT INTO {0} VALUES (%s, %s, %s, %s, %s, %s, %s);".format(stats),
+        [(part, col, profile.num_rows, profile.nulls[col],
+          None if col not in profile.mins else str(profile.mins[col]),
+          None if col not in profile.maxs else str(profile.maxs[col]),
+          profile.totals.get(col))
+         for col in schema.COLUMNS])
+    rows = [(part, col, value, num)
+            for col in COUNTED_COLUMNS
+            for value, num in profile.counts[col].items()]
+    rows += [(part, col, None, profile.nulls[col])
+             for col in COUNTED_COLUMNS if profile.nulls[col]]
+    cur.executemany(
+        "INSERT INTO {0} VALUES (%s, %s, %s, %s);".format(counts), rows)
+
+
+def summary(cur, table_name):
+    """
+    Get the stored profile of the whole table in a database.
+
+    Returns
+    -------
+    dict
+        The (num_rows, nulls, total) of each column, by column.
+    """
+    cur.execute("SELECT col, SUM(num_rows)::bigint, SUM(nulls)::bigint, "
+                "SUM(total)::bigint FROM {0} GROUP BY col;".format(
+                    stats_table(table_name)))
+    return dict((row[0], tuple(row[1:])) for row in cur.fetchall())
+
+
+def scan_sql(table_name):
+    """
+    Query computing, in one scan of the table, the same (num_rows, nulls,
+    total) of each column as `summary()`, as a single row of values in the
+    order of `schema.COLUMNS`.
+    """
+    cols = []
+    for col in schema.COLUMNS:
+        cols.append("COUNT(*) - COUNT({0})".format(col))
+        if col in SUMMED_COLUMNS:
+            cols.append("SUM({0})::bigint".format(col))
+    return "SELECT COUNT(*), {0} FROM {1}".format(", ".join(cols), table_name)
+
+
+def parse_scan(row):
+    """
+    Turn the row returned by `scan_sql()` into the layout of `summary()`.
+    """
+    values = iter(row[1:])
+    result = {}
+    for col in schema.COLUMNS:
+        nulls = next(values)
+        total = next(values) if col in SUMMED_COLUMNS else None
+        result[col] = (row[0], nulls, total)
+    return result
+
+
+def total_sql(table_name):
+    """Query counting the rows of the table, from its stats."""
+    return ("SELECT COALESCE(SUM(num_rows), 0)::bigint FROM {0} "
+            "WHERE col = 'id'".format(stats_table(table_name)))
+
+
+def count_sql(col, table_name):
+    """
+    Query counting the rows with each value of one of COUNTED_COLUMNS, from
+    its stats, returning (value, num) rows of the same types as a query on
+    the table.
+    """
+    return ("SELECT value::{0} AS {1}, SUM(num)::bigint AS num FROM {2} "
+            "WHERE col = '{1}' GROUP BY 1".format(
+                _CASTS[schema.COLUMNS[col]], col, counts_table(table_name)))
+
+
+def average_sql(col, table_name):
+    """
+    Query returning the (total, num) of one of SUMMED_COLUMNS, from its
+    stats.
+    """
+    return ("SELECT SUM(total)::bigint AS total, "
+            "SUM(num_rows - nulls)::bigint AS num FROM {0} "
+            "WHERE col = '{1}'".format(stats_table(table_name), col))
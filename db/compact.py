@@ -0,0 +1,215 @@
+"""Compact storage layout of the beneficiary table, built by
+`data_loader.py --compact`.
+
+The full-width table is split in three:
+
+* a facts table holding the columns every scan needs, with the state stored
+  as a SMALLINT code and the 12 disease flags packed into one SMALLINT
+  bitmask;
+* a payments table holding the nine reimbursement and responsibility columns,
+  only for the rows where at least one of them is non-zero, since most are;
+* a lookup table of state codes.
+
+The original table is replaced by a view with its columns, so row exports,
+filters and anything else written against the wide table keep working, while
+the aggregate queries built here scan the narrow tables directly.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from db import schema
+
+STATE_CODES_TABLE = 'state_codes'
+
+# Columns stored in the payments table rather than the facts table
+PAYMENT_COLUMNS = schema.PAYMENT_COLUMNS
+
+# Columns stored as they are in the facts table
+FACT_COLUMNS = ('id', 'dob', 'dod', 'sex', 'race', 'county_code',
+                'part_a_coverage_months', 'part_b_coverage_months',
+                'hmo_coverage_months', 'part_d_coverage_months')
+
+# Columns narrowed to SMALLINT in the facts table
+SMALLINT_COLUMNS = ('part_a_coverage_months', 'part_b_coverage_months',
+                    'hmo_coverage_months', 'part_d_coverage_months')
+
+
+def facts_table(table_name):
+    """Name of the facts table of a table."""
+    return '{0}_facts'.format(table_name)
+
+
+def payments_table(table_name):
+    """Name of the payments table of a table."""
+    return '{0}_payments'.format(table_name)
+
+
+def disease_bit(col):
+    """
+    Get the bit of a disease flag in the `diseases` bitmask.
+
+    Parameters
+    ----------
+    col : str, unicode
+        A column in `schema.DISEASE_COLUMNS`.
+
+    Returns
+    -------
+    int
+    """
+    return 1 << schema.DISEASE_COLUMNS.index(col)
+
+
+def create_sql(table_name, state_codes):
+    """
+    Get the SQL that builds the compact tables from a loaded table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        The full-width table.
+    state_codes : dict
+        State abbreviations by code, as coded in the downloaded data.
+
+    Returns
+    -------
+    list of str, unicode
+        Statements to execute in order.
+    """
+    facts = facts_table(table_name)
+    payments = payments_table(table_name)
+    values = ", ".join("({0}, '{1}')".format(code, state)
+                       for code, state in sorted(state_codes.items()))
+    cols = ", ".join(
+        "t.{0}::smallint AS {0}".format(col) if col in SMALLINT_COLUMNS
+        else "t.{0}".format(col) for col in FACT_COLUMNS)
+    bitmask = " | ".join("(t.{0}::int << {1})".format(col, i)
+                         for i, col in enumerate(schema.DISEASE_COLUMNS))
+    nonzero = " OR ".join("{0} <> 0".format(col) for col in PAYMENT_COLUMNS)
+    return [
+        "CREATE TABLE {0} (code SMALLINT PRIMARY KEY, "
+        "state VARCHAR(4) NOT NULL);".format(STATE_CODES_TABLE),
+        "INSERT INTO {0} VALUES {1};".format(STATE_CODES_TABLE, values),
+        # Some abbreviations have more than one code, so map each to one
+        """
+        CREATE TABLE {0} AS SELECT {1}, s.code AS state_code,
+        ({2})::smallint AS diseases FROM {3} t JOIN (SELECT state,
+        MIN(code) AS code FROM {4} GROUP BY state) s ON s.state = t.state
+        ORDER BY t.id;""".format(facts, cols, bitmask, table_name,
+                                 STATE_CODES_TABLE),
+        "ALTER TABLE {0} ADD PRIMARY KEY (id);".format(facts),
+        "CREATE TABLE {0} AS SELECT id, {1} FROM {2} WHERE {3} "
+        "ORDER BY id;".format(payments, ", ".join(PAYMENT_COLUMNS),
+                              table_name, nonzero),
+        "ALTER TABLE {0} ADD PRIMARY KEY (id);".format(payments),
+        "ANALYZE {0};".format(facts),
+        "ANALYZE {0};".format(payments),
+    ]
+
+
+def replace_sql(table_name):
+    """
+    Get the SQL that drops the full-width table and replaces it with a view of
+    the compact tables.
+
+    Returns
+    -------
+    list of str, unicode
+        Statements to execute in order.
+    """
+    cols = []
+    for col in schema.COLUMNS:
+        if col == 'state':
+            cols.append("s.state")
+        elif col in schema.DISEASE_COLUMNS:
+            cols.append("(f.diseases & {0}) <> 0 AS {1}".format(
+                disease_bit(col), col))
+        elif col in PAYMENT_COLUMNS:
+            cols.append("COALESCE(p.{0}, 0) AS {0}".format(col))
+        elif col in SMALLINT_COLUMNS:
+            cols.append("f.{0}::int AS {0}".format(col))
+        else:
+            cols.append("f.{0}".format(col))
+    return [
+        "DROP TABLE {0};".format(table_name),
+        """
+        CREATE VIEW {0} AS SELECT {1} FROM {2} f JOIN {3} s
+        ON s.code = f.state_code LEFT JOIN {4} p
+        ON p.id = f.id;""".format(table_name, ", ".join(cols),
+                                  facts_table(table_name), STATE_CODES_TABLE,
+                                  payments_table(table_name)),
+    ]
+
+
+def drop_sql(table_name):
+    """
+    Get the SQL that drops the compact tables and the view of them, if they
+    exist.
+
+    Returns
+    -------
+    list of str, unicode
+    """
+    return [
+        "DROP TABLE IF EXISTS {0} CASCADE;".format(facts_table(table_name)),
+        "DROP TABLE IF EXISTS {0};".format(payments_table(table_name)),
+        "DROP TABLE IF EXISTS {0};".format(STATE_CODES_TABLE),
+    ]
+
+
+def total_sql(table_name):
+    """Query counting the rows of the table."""
+    return "SELECT COUNT(*) FROM {0}".format(facts_table(table_name))
+
+
+def count_sql(col, table_name):
+    """
+    Query counting the rows with each value of a column, returning
+    (value, num) rows like the query on the full-width table.
+    """
+    facts = facts_table(table_name)
+    if col == 'state':
+        return ("SELECT s.state, SUM(c.num)::bigint AS num FROM (SELECT "
+                "state_code, COUNT(*) AS num FROM {0} GROUP BY state_code) c "
+                "JOIN {1} s ON s.code = c.state_code "
+                "GROUP BY s.state".format(facts, STATE_CODES_TABLE))
+    if col in schema.DISEASE_COLUMNS:
+        return ("SELECT (diseases & {0}) <> 0 AS {1}, COUNT(*) AS num "
+                "FROM {2} GROUP BY 1".format(disease_bit(col), col, facts))
+    if col in PAYMENT_COLUMNS:
+        # Rows missing from the payments table have a value of 0
+        return ("SELECT {0}, SUM(num)::bigint AS num FROM (SELECT {0}, "
+                "COUNT(*) AS num FROM {1} GROUP BY {0} UNION ALL SELECT 0, "
+                "(SELECT COUNT(*) FROM {2}) - (SELECT COUNT(*) FROM {1})) u "
+                "GROUP BY {0} HAVING SUM(num) > 0".format(
+                    col, payments_table(table_name), facts))
+    return "SELECT {0}, COUNT(*) AS num FROM {1} GROUP BY {0}".format(
+        col, facts)
+
+
+def average_sql(col, table_name):
+    """
+    Query returning the (total, num) of a numeric column, from which its
+    average is computed.
+    """
+    facts = facts_table(table_name)
+    if col in PAYMENT_COLUMNS:
+        return ("SELECT SUM({0}) AS total, (SELECT COUNT(*) FROM {1}) AS num "
+                "FROM {2}".format(col, facts, payments_table(table_name)))
+    return "SELECT SUM({0}) AS total, COUNT({0}) AS num FROM {1}".format(
+        col, facts)
+
+
+def frequency_sql(col, table_name):
+    """
+    Query returning the (state, claims, cases) of a disease flag in each
+    state.
+    """
+    return ("SELECT s.state, SUM(c.claims)::bigint AS claims, "
+            "SUM(c.cases)::bigint AS cases FROM (SELECT state_code, "
+            "COUNT(*) AS claims, SUM(CASE WHEN (diseases & {0}) <> 0 THEN 1 "
+            "ELSE 0 END) AS cases FROM {1} GROUP BY state_code) c JOIN {2} s "
+            "ON s.code = c.state_code GROUP BY s.state".format(
+                disease_bit(col), facts_table(table_name), STATE_CODES_TABLE))
@@ -1,11 +1,25 @@
-from db import rds_password
 import os
 
+try:
+    from db import rds_password
+except ImportError:
+    # Not needed on Vagrant, and the fabfile reports it missing for RDS
+    rds_password = None
+
 # Change the following settings to match your RDS instance
 rds_dbhost = "cmsdata.chtdutbma0ig.us-west-2.rds.amazonaws.com"  # Change
 rds_dbname = "BENEFICIARYDATA"  # Change
 rds_dbuser = "nikhil"  # Change
-rds_dbpass = rds_password.rds_pass  # Set this in a file `db/rds_password.py`
+# Set this in a file `db/rds_password.py`
+rds_dbpass = rds_password.rds_pass if rds_password is not None else None
+# Read replicas of the RDS instance, which share its name, user and password.
+# The server spreads its queries over them; data is always loaded to the host
+# above.
+rds_replica_hosts = []  # Change, e.g. ["replica-1.xxx.rds.amazonaws.com"]
+# Databases to shard the table across by a hash of `id`, which share the name,
+# user and password above. Leave empty to keep the whole table on the host
+# above.
+rds_shard_hosts = []  # Change, e.g. ["shard-0.xxx.rds.amazonaws.com", ...]
 
 # Change to correspond to your EC2 IP address and path to .pem file
 ec2_pem = os.path.join('/', 'Users', 'Nikhil', '.ssh', 'aws.pem')  # Change
@@ -16,6 +30,18 @@ vagrant_dbhost = "localhost"
 vagrant_dbname = "beneficiary_data"  # Keep lowercase
 vagrant_dbuser = "vagrant"
 vagrant_dbpass = None
+# Optional extra local Postgres instances, as "host:port", to use as replicas
+vagrant_replica_hosts = []
+# Optional local Postgres instances, as "host:port", to shard the table across
+vagrant_shard_hosts = []
 
 # Global table name to use on RDS and Vagrant
 db_tablename = "beneficiary_sample_2010"
+# Whether to load the table in the compact layout of db/compact.py, and have
+# the server query it. Reload the data after changing this.
+db_compact = False
+# Whether the server reads row counts, value counts and averages from the
+# column stats stored by the data loader (db/column_stats.py). Only set it to
+# True once the table has been reloaded by a loader that stores them; a table
+# loaded before then has no stats tables.
+db_column_stats = False
@@ -49,9 +49,14 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import collections
 import csv
+import datetime
 import glob
 import io
+import itertools
+import json
+import multiprocessing
 import os
 import sys
 import urlparse
@@ -62,22 +67,71 @@ import requests
 
 # Need to append parent dir to path so you can import files in sister dirs
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from db import ages
+from db import column_stats
+from db import compact
 from db import config as dbconfig
+from db import load_state
+from db import rollups
+from db import schema
+from core import notify
+from core.sharding import shard_for
 from core.utilities import cursor_connect
 
 TABLE_NAME = dbconfig.db_tablename
 
+# Number of lines of the downloaded CSV files sent to each worker at a time
+PREP_CHUNK_SIZE = 20000
+
+# Where downloaded data files are kept until all their rows are loaded, and
+# the prefix of the prepared CSV files
+DOWNLOAD_DIR = 'downloads'
+PREPPED_PREFIX = 'prepped_medicare'
+
+# Maps from the coded values in the downloaded CSV files to the values loaded
+# in the DB
+STATES_MAP = dict(
+    (i + 1, val.encode('ascii')) for i, val in enumerate((
+        'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC',
+        'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY',
+        'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT',
+        'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH',
+        'OK', 'OR', 'PA', '__', 'RI', 'SC', 'SD', 'TN', 'TX',
+        'UT', 'VT', '__', 'VA', 'WA', 'WV', 'WI', 'WY', 'Othr')))
+SEX_MAP = {'1': 'male'.encode('ascii'), '2': 'female'.encode('ascii')}
+RACE_MAP = {
+    '1': 'white'.encode('ascii'),
+    '2': 'black'.encode('ascii'),
+    '3': 'others'.encode('ascii'),
+    '5': 'hispanic'.encode('ascii')
+}
+BOOLEAN_MAP = {'1': '1'.encode('ascii'), '2': '0'.encode('ascii')}
+
 # Parse arguments
 argparser = argparse.ArgumentParser(
     description="Load synthetic CMS 2010 summary beneficiary data into "
                 "Postgres.",
     epilog="example: python data_loader.py --host localhost --dbname Nikhil "
            "--user Nikhil")
-argparser.add_argument("--host", required=True, help="location of database")
+argparser.add_argument("--host", required=True,
+                       help="location of the primary database")
 argparser.add_argument("--dbname", required=True, help="name of database")
 argparser.add_argument("--user", required=True, help="user to access database")
 argparser.add_argument("--password", required=False, help="password to connect")
-args = argparser.parse_args()
+argparser.add_argument("--shards", required=False,
+                       help="comma-separated hosts to shard the table across "
+                            "instead of loading it to --host")
+argparser.add_argument("--workers", type=int,
+                       default=multiprocessing.cpu_count(),
+                       help="number of processes to prepare the data with "
+                            "(default: number of CPUs)")
+argparser.add_argument("--compact", action='store_true',
+                       help="store the table in the compact layout of "
+                            "db/compact.py; set db_compact in db/config.py "
+                            "to match")
+argparser.add_argument("--resume", action='store_true',
+                       help="resume a failed load, skipping the data files "
+                            "already loaded into each database")
 
 # Declare URLs of CSV files to download
 base_url = (
@@ -92,7 +146,7 @@ DATA_FILES = [
     for i in range(1, 21)]
 
 
-def download_zip(uri):
+def download_zip(uri, path=None):
     """
     Download an zipped data file and return the unzipped file.
 
@@ -100,6 +154,10 @@ def download_zip(uri):
     ----------
     uri : str, unicode
         The URI for the .zip file.
+    path : str, unicode, optional
+        Where to save the .zip file. If a file is already there it is used
+        instead of downloading it again. The file only appears once it has
+        been completely downloaded.
 
     Returns
     -------
@@ -111,9 +169,18 @@ def download_zip(uri):
             for line in f.readlines():
                 print line
     """
+    if path is not None and os.path.isfile(path):
+        z = zipfile.ZipFile(path)
+        return z.open(z.namelist()[0])
     r = requests.get(uri)
     if r.status_code == requests.codes.ok:
-        z = zipfile.ZipFile(io.BytesIO(r.content))
+        if path is None:
+            z = zipfile.ZipFile(io.BytesIO(r.content))
+        else:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(r.content)
+            os.rename(path + '.tmp', path)
+            z = zipfile.ZipFile(path)
         csv_file = z.namelist()[0]
         f = z.open(csv_file)
     else:
@@ -123,14 +190,27 @@ def download_zip(uri):
     return f
 
 
-def drop_table():
+def drop_table(dsn):
     """
-    Drop the table specified by TABLE_NAME.
+    Drop the table specified by TABLE_NAME, its rollups, its age rollup, its
+    load state and column stats, and its compact tables if it was loaded with
+    `--compact`.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database to drop the table from.
     """
-    con, cur = cursor_connect(db_dsn)
+    con, cur = cursor_connect(dsn)
     try:
+        for sql in rollups.drop_sql(TABLE_NAME) + ages.drop_sql(TABLE_NAME) + \
+                compact.drop_sql(TABLE_NAME):
+            cur.execute(sql)
         sql = "DROP TABLE IF EXISTS {0};".format(TABLE_NAME)
         cur.execute(sql)
+        cur.execute(load_state.drop_sql(TABLE_NAME))
+        for sql in column_stats.drop_sql(TABLE_NAME):
+            cur.execute(sql)
     except psycopg2.Error:
         raise
     else:
@@ -139,11 +219,41 @@ def drop_table():
         con.close()
 
 
-def create_table():
+def relation_exists(dsn, name):
+    """
+    Check whether a table or view exists.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database to look in.
+    name : str, unicode
+        Name of the table or view.
+
+    Returns
+    -------
+    bool
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        cur.execute("SELECT 1 FROM information_schema.tables "
+                    "WHERE table_name = %s;", (name, ))
+        return cur.fetchone() is not None
+    finally:
+        cur.close()
+        con.close()
+
+
+def create_table(dsn):
     """
     Create the table given by TABLE_NAME.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database to create the table in.
     """
-    con, cur = cursor_connect(db_dsn)
+    con, cur = cursor_connect(dsn)
     # Create new column types, like factors in R, to hold sex and race.
     new_types = [
         ("CREATE TYPE sex AS ENUM ('male', 'female');",),
@@ -156,7 +266,7 @@ def create_table():
         except psycopg2.ProgrammingError as e:
             # If the types already exist just continue on
             if "already exists" in e.message:
-                con, cur = cursor_connect(db_dsn)  # Re-create the connection
+                con, cur = cursor_connect(dsn)  # Re-create the connection
             else:
                 cur.close()
                 con.close()
@@ -205,22 +315,44 @@ def create_table():
         con.close()
 
 
-def load_csv(csv_file):
+def load_csv(dsn, csv_file, part=None, profile=None):
     """
     Load data from a CSV file or file-like object into the database.
 
     Parameters
     ----------
+    dsn : str, unicode
+        DSN of the database to load the data into.
     csv_file : str, unicode
         A file of file-like object returned from download_zip(). The file must
         have both `read()` and `readline()` methods.
+    part : str, unicode, optional
+        The part the file holds. Its load state is moved to the copied stage
+        in the same transaction as the COPY, so if either fails neither
+        happens, and the part can be loaded again.
+    profile : column_stats.ColumnProfile, optional
+        The profile of the file's rows, stored with the part. The load fails
+        if the COPY loaded a different number of rows.
 
     """
-    con, cur = cursor_connect(db_dsn)
+    num_rows = profile.num_rows if profile is not None else None
+    con, cur = cursor_connect(dsn)
     try:
         with open(csv_file, 'r') as f:
             cur.copy_from(f, TABLE_NAME, sep=',', null='')
-    except psycopg2.Error:
+        # rowcount is -1 if the server doesn't report the rows copied
+        if num_rows is not None and cur.rowcount not in (-1, num_rows):
+            raise ValueError("{0} rows copied from {1}. Should be {2}".format(
+                             cur.rowcount, csv_file, num_rows))
+        if part is not None:
+            if profile is not None:
+                column_stats.save(cur, TABLE_NAME, part, profile)
+            load_state.set_stage(cur, TABLE_NAME, part, load_state.COPIED,
+                                 num_rows)
+    except (psycopg2.Error, ValueError):
+        con.rollback()
+        cur.close()
+        con.close()
         raise
     else:
         con.commit()
@@ -228,81 +360,172 @@ def load_csv(csv_file):
         con.close()
 
 
-def prep_csv(csv_file):
+def transform_row(row):
     """
-    Modifies the CMS Medicare data to get it ready to load in the DB.
+    Transform a row of the CMS Medicare data to get it ready to load in the DB.
 
     Important modifications are transforming character columns to 0 and 1 for
     import into BOOLEAN Postgres columns.
 
+    Parameters
+    ----------
+    row : list of str
+        A row of the downloaded CSV file, which is modified in place.
+
+    Returns
+    -------
+    list of str
+        The transformed row.
+    """
+    # Transform state
+    row[6] = STATES_MAP[int(row[6])]
+    # Transform 'Y' for 'yes' into 1, for boolean
+    if row[5] == 'Y':
+        row[5] = '1'.encode('ascii')
+    # Transform sex into factors
+    row[3] = SEX_MAP[row[3]]
+    # Transform race into factors (note: there is no '4' value...)
+    row[4] = RACE_MAP[row[4]]
+    # Transform 'boolean' 1 and 2 into 0 and 1, for columns 12 - 22
+    for i in range(12, 23):
+        row[i] = BOOLEAN_MAP[row[i]]
+    # Transform strings to floats to ints
+    for i in range(23, 32):
+        row[i] = str(int(float(row[i]))).encode('ascii')
+    return row
+
+
+def transform_chunk(lines, num_shards=1):
+    """
+    Transform a chunk of lines of the CMS Medicare data into CSV text for each
+    shard, profiling the transformed rows as they go. Runs in the worker
+    processes of `prep_csv()`.
+
+    Parameters
+    ----------
+    lines : list of str
+        Lines of the downloaded CSV file.
+    num_shards : int
+        Number of shards to split the rows between, by a hash of their `id`.
+
+    Returns
+    -------
+    (list of str, list of column_stats.ColumnProfile)
+        The CSV text of the transformed rows of each shard, in their original
+        order, and the profile of each shard's rows.
+    """
+    bufs = [io.BytesIO() for _ in range(num_shards)]
+    writers = [csv.writer(buf) for buf in bufs]
+    profiles = [column_stats.ColumnProfile() for _ in range(num_shards)]
+    for row in csv.reader(lines):
+        row = transform_row(row)
+        shard = shard_for(row[0], num_shards)
+        writers[shard].writerow(row)
+        profiles[shard].add(row)
+    return [buf.getvalue() for buf in bufs], profiles
+
+
+def prep_csv(csv_file, num_shards=1, workers=1, chunk_size=PREP_CHUNK_SIZE,
+             prefix=PREPPED_PREFIX):
+    """
+    Modifies the CMS Medicare data to get it ready to load in the DB.
+
+    The file is read in chunks of lines, which are transformed by
+    `transform_chunk()` in a pool of worker processes. The transformed chunks
+    are appended to the output files in the order they were read, so the
+    order of the rows is preserved. The profiles of the chunks are merged
+    into a profile of each output file, written next to it with the suffix
+    '.profile.json' (see `db.column_stats`). The output files only appear
+    once they and their profiles are complete.
+
     Parameters
     ----------
     csv_file : zipfile.ZipExtFile
         A CSV-like object returned from download_zip().
+    num_shards : int
+        Number of shards to split the rows between, by a hash of their `id`.
+    workers : int
+        Number of worker processes to transform the chunks in. With 1 the
+        chunks are transformed in this process.
+    chunk_size : int
+        Number of lines sent to a worker at a time.
+    prefix : str, unicode
+        Prefix of the names of the output files.
 
     Returns
     -------
-    str
-        Path to a prepared CSV file on disk.
-    """
-    states = ('AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC',
-              'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY',
-              'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT',
-              'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH',
-              'OK', 'OR', 'PA', '__', 'RI', 'SC', 'SD', 'TN', 'TX',
-              'UT', 'VT', '__', 'VA', 'WA', 'WV', 'WI', 'WY', 'Othr')
-    states_map = {}
-    for i, val in enumerate(states):
-        states_map[i + 1] = val
-    prepped_filename = 'prepped_medicare.csv'
-    reader = csv.reader(csv_file)
-    with open(prepped_filename, 'a') as f:
-        writer = csv.writer(f)
-        for row in reader:
-            # Transform state
-            row[6] = states_map[int(row[6])]
-            # Transform 'Y' for 'yes' into 1, for boolean
-            if row[5] == 'Y':
-                row[5] = '1'.encode('ascii')
-            # Transform sex into factors
-            sex = {'1': 'male'.encode('ascii'), '2': 'female'.encode('ascii')}
-            row[3] = sex[row[3]]
-            # Transform race into factors (note: there is no '4' value...)
-            race = {
-                '1': 'white'.encode('ascii'),
-                '2': 'black'.encode('ascii'),
-                '3': 'others'.encode('ascii'),
-                '5': 'hispanic'.encode('ascii')
-            }
-            row[4] = race[row[4]]
-            # Transform 'boolean' 1 and 2 into 0 and 1, for columns 12 - 22
-            boolean_transform = {
-                '1': '1'.encode('ascii'),
-                '2': '0'.encode('ascii')
-            }
-            for i in range(12, 23):
-                row[i] = boolean_transform[row[i]]
-            # Transform strings to floats to ints
-            for i in range(23, 32):
-                row[i] = str(int(float(row[i]))).encode('ascii')
-            writer.writerow(row)
-    return prepped_filename
-
-
-def alter_col_types():
+    list of str
+        Path to the prepared CSV file on disk of each shard.
+    """
+    prepped_filenames = ['{0}_{1}.csv'.format(prefix, i)
+                         for i in range(num_shards)]
+    files = [open(filename + '.tmp', 'w') for filename in prepped_filenames]
+    profiles = [column_stats.ColumnProfile() for _ in range(num_shards)]
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+    def write(result):
+        chunks, chunk_profiles = result
+        for f, data in zip(files, chunks):
+            f.write(data)
+        for profile, chunk_profile in zip(profiles, chunk_profiles):
+            profile.merge(chunk_profile)
+
+    try:
+        # Keep a bounded number of chunks in flight so the whole file isn't
+        # read into memory when the workers fall behind
+        max_pending = 2 * workers
+        pending = collections.deque()
+        while True:
+            lines = list(itertools.islice(csv_file, chunk_size))
+            if not lines:
+                break
+            if pool is None:
+                write(transform_chunk(lines, num_shards))
+                continue
+            pending.append(pool.apply_async(transform_chunk,
+                                            (lines, num_shards)))
+            if len(pending) >= max_pending:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for f in files:
+            f.close()
+    for filename, profile in zip(prepped_filenames, profiles):
+        profile.dump(filename + '.profile.json')
+        os.rename(filename + '.tmp', filename)
+    return prepped_filenames
+
+
+def alter_col_types(dsn):
     """
     Alter column types of the table to better suit the data.
 
-    For example, convert the character-represented-dates to type DATE.
+    For example, convert the character-represented-dates to type DATE. Columns
+    that are already DATEs are left alone, so a resumed load can run it again.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database holding the table.
     """
-    con, cur = cursor_connect(db_dsn)
+    con, cur = cursor_connect(dsn)
     try:
         # Get column names so you can index the 2th and 3th columns
         sql = "SELECT * FROM {0} LIMIT 0;".format(TABLE_NAME)
         cur.execute(sql)
         colnames = [desc[0] for desc in cur.description]
         cols = (colnames[1], colnames[2])  # DO-Birth and DO-Death
+        cur.execute("SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = %s AND data_type = 'date';",
+                    (TABLE_NAME, ))
+        dates = set(row[0] for row in cur.fetchall())
         for col in cols:
+            if col in dates:
+                continue
             sql = """
             ALTER TABLE {0} ALTER COLUMN {1} TYPE DATE
             USING to_date({1}, 'YYYYMMDD');
@@ -316,64 +539,392 @@ def alter_col_types():
         con.close()
 
 
-def verify_data_load():
+def build_rollups(dsn):
     """
-    Verify that all the data was loaded into the DB.
+    Build the county and state rollups of the table, see `db.rollups`,
+    replacing any built by an earlier run.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database holding the table.
     """
-    con, cur = cursor_connect(db_dsn)
+    con, cur = cursor_connect(dsn)
     try:
-        sql = "SELECT COUNT(*) FROM {0}".format(TABLE_NAME)
-        cur.execute(sql)
-        result = cur.fetchone()
-        num_rows = result[0]
+        for sql in rollups.drop_sql(TABLE_NAME) + \
+                rollups.create_sql(TABLE_NAME):
+            cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def build_age_rollup(dsn):
+    """
+    Build the age and mortality rollup of the table, see `db.ages`,
+    replacing any built by an earlier run. The `dob` and `dod` columns must
+    already be DATEs.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database holding the table.
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        for sql in ages.drop_sql(TABLE_NAME) + ages.create_sql(TABLE_NAME):
+            cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def measure_scans(cur, tables, queries):
+    """
+    Measure the size of tables and the time taken by queries on them.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        A cursor on the database holding the tables.
+    tables : list of str, unicode
+        The tables to measure the total size of, including indexes.
+    queries : list of str, unicode
+        The queries to time. Each is run once to warm the cache before it is
+        timed.
+
+    Returns
+    -------
+    (int, list of float)
+        The total size in bytes, and the execution time of each query in
+        milliseconds.
+    """
+    size = 0
+    for table in tables:
+        cur.execute("SELECT pg_total_relation_size(%s);", (table, ))
+        size += cur.fetchone()[0]
+    times = []
+    for query in queries:
+        cur.execute(query)
+        cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query)
+        plan = cur.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        times.append(plan[0].get('Execution Time',
+                                 plan[0].get('Total Runtime')))
+    return size, times
+
+
+def compact_table(dsn):
+    """
+    Replace the table with the compact layout of `db.compact`, and print how
+    it changes the table's size and the time taken by aggregate scans. Does
+    nothing if the table is already compact.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database holding the table.
+    """
+    if relation_exists(dsn, compact.facts_table(TABLE_NAME)):
+        return
+    con, cur = cursor_connect(dsn)
+    try:
+        for sql in compact.create_sql(TABLE_NAME, STATES_MAP):
+            cur.execute(sql)
+        wide = measure_scans(cur, [TABLE_NAME], [
+            "SELECT state, COUNT(*), SUM(CASE WHEN diabetes THEN 1 ELSE 0 "
+            "END) FROM {0} GROUP BY state".format(TABLE_NAME),
+            "SELECT SUM(carrier_reimbursement), COUNT(carrier_reimbursement) "
+            "FROM {0}".format(TABLE_NAME),
+        ])
+        narrow = measure_scans(cur, [
+            compact.facts_table(TABLE_NAME),
+            compact.payments_table(TABLE_NAME),
+            compact.STATE_CODES_TABLE,
+        ], [
+            compact.frequency_sql('diabetes', TABLE_NAME),
+            compact.average_sql('carrier_reimbursement', TABLE_NAME),
+        ])
+        for sql in compact.replace_sql(TABLE_NAME):
+            cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+    print("Table size: {0:,} bytes wide, {1:,} bytes compact.".format(
+          wide[0], narrow[0]))
+    for name, wide_time, narrow_time in zip(
+            ('Disease frequency', 'Average'), wide[1], narrow[1]):
+        print("{0} scan: {1:.0f} ms wide, {2:.0f} ms compact.".format(
+              name, wide_time, narrow_time))
+
+
+def create_load_state(dsn):
+    """
+    Create the load state and column stats tables, if they don't exist, see
+    `db.load_state` and `db.column_stats`.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database the table is loaded into.
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        cur.execute(load_state.create_sql(TABLE_NAME))
+        for sql in column_stats.create_sql(TABLE_NAME):
+            cur.execute(sql)
     except psycopg2.Error:
         raise
     else:
+        con.commit()
         cur.close()
         con.close()
-        expected_row_count = 2255098
-        if num_rows != expected_row_count:
+
+
+def get_load_stages(dsn):
+    """
+    Get the stage each part has reached in a database.
+
+    Returns
+    -------
+    dict
+        The stage of each part, by part.
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        return load_state.get_stages(cur, TABLE_NAME)
+    finally:
+        cur.close()
+        con.close()
+
+
+def mark_stage(dsn, part, stage, num_rows=None):
+    """
+    Record the stage a part has reached in a database.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database.
+    part : str, unicode
+        Name of the part.
+    stage : str, unicode
+        One of `load_state.STAGES`.
+    num_rows : int, optional
+        Number of rows of the part in the database.
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        load_state.set_stage(cur, TABLE_NAME, part, stage, num_rows)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def verify_shard(dsn):
+    """
+    Verify that a database holds every row of the parts copied into it, and
+    move those parts to the verified stage.
+
+    The table's row count, the null count of every column and the total of
+    every numeric column are computed in a single scan and compared with the
+    column stats stored with the parts.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database.
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        expected_rows = load_state.copied_rows(cur, TABLE_NAME)
+        expected = column_stats.summary(cur, TABLE_NAME)
+        cur.execute(column_stats.scan_sql(TABLE_NAME))
+        actual = column_stats.parse_scan(cur.fetchone())
+        if actual['id'][0] != expected_rows:
             raise AssertionError("{0} rows in DB. Should be {1}".format(
-                                 num_rows, expected_row_count))
-        print("Data load complete.")
+                                 actual['id'][0], expected_rows))
+        for col in schema.COLUMNS:
+            if actual[col] != expected.get(col):
+                raise AssertionError(
+                    "Column {0} has (rows, nulls, total) {1} in DB. Should "
+                    "be {2}".format(col, actual[col], expected.get(col)))
+        for part, stage in load_state.get_stages(cur, TABLE_NAME).items():
+            if stage == load_state.COPIED:
+                load_state.set_stage(cur, TABLE_NAME, part,
+                                     load_state.VERIFIED)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def remove_files(pattern):
+    """Delete the files matching a glob pattern, ignoring missing ones."""
+    for path in glob.glob(pattern):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def publish_data_version(dsn):
+    """
+    Notify the server's workers that the table has been reloaded, so they
+    drop their caches, see `core.notify`.
+
+    Parameters
+    ----------
+    dsn : str, unicode
+        DSN of the database the workers listen on.
+    """
+    con, cur = cursor_connect(dsn)
+    try:
+        notify.publish(cur, datetime.datetime.utcnow().isoformat())
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def verify_data_load(dsns):
+    """
+    Verify that all the data was loaded into the DB, from the row counts in
+    the column stats of each database, which `verify_shard()` has checked
+    against the table.
+
+    Parameters
+    ----------
+    dsns : list of str, unicode
+        DSN of each database the table was loaded into.
+    """
+    num_rows = 0
+    for dsn in dsns:
+        con, cur = cursor_connect(dsn)
+        try:
+            cur.execute(column_stats.total_sql(TABLE_NAME))
+            result = cur.fetchone()
+            num_rows += result[0]
+        except psycopg2.Error:
+            raise
+        else:
+            cur.close()
+            con.close()
+    expected_row_count = 2255098
+    if num_rows != expected_row_count:
+        raise AssertionError("{0} rows in DB. Should be {1}".format(
+                             num_rows, expected_row_count))
+    print("Data load complete.")
 
 if __name__ == '__main__':
+    args = argparser.parse_args()
     # Create the database's DNS to connect with using psycopg2
     db_dsn = "host={0} dbname={1} user={2} password={3}".format(
         args.host, args.dbname, args.user, args.password
     )
-    # Delete any orphaned data file that might exist
-    try:
-        csv_files = glob.glob('*.csv')
-        for f in csv_files:
-            os.remove(f)
-    except:
-        pass
-    # Delete the table and recreate it if it exists
-    print("Dropping table.")
-    drop_table()
-    print("Creating table.")
-    create_table()
-    # Download the data and load it into the DB
-    try:
-        for uri in DATA_FILES:
-            print("Downloading {0}".format(uri.split('/')[-1]))
-            medicare_csv = download_zip(uri)
+    # Shard the table across several databases if asked, otherwise load it all
+    # to the one database
+    if args.shards:
+        db_dsns = [
+            "host={0} dbname={1} user={2} password={3}".format(
+                host.strip(), args.dbname, args.user, args.password)
+            for host in args.shards.split(',')]
+    else:
+        db_dsns = [db_dsn]
+    num_shards = len(db_dsns)
+    if args.resume:
+        print("Resuming the previous load.")
+        for dsn in db_dsns:
+            if not relation_exists(dsn, TABLE_NAME):
+                create_table(dsn)
+    else:
+        # Delete any orphaned data files of an earlier load
+        remove_files('{0}_*.csv*'.format(PREPPED_PREFIX))
+        remove_files(os.path.join(DOWNLOAD_DIR, '*.zip*'))
+        # Delete the table and recreate it if it exists
+        print("Dropping table.")
+        for dsn in db_dsns:
+            drop_table(dsn)
+        print("Creating table.")
+        for dsn in db_dsns:
+            create_table(dsn)
+    for dsn in db_dsns:
+        create_load_state(dsn)
+    if not os.path.isdir(DOWNLOAD_DIR):
+        os.makedirs(DOWNLOAD_DIR)
+    stages = [get_load_stages(dsn) for dsn in db_dsns]
+    # Download the data and load it into the DB, one data file (part) at a
+    # time, recording each part's progress in every database. Files are kept
+    # if the load fails, so `--resume` can pick up where it stopped.
+    for uri in DATA_FILES:
+        filename = uri.split('/')[-1]
+        part = os.path.splitext(filename)[0]
+        shards = [i for i in range(num_shards) if not load_state.reached(
+                  stages[i].get(part), load_state.COPIED)]
+        if not shards:
+            print("Skipping {0}, already loaded.".format(filename))
+            continue
+        prefix = '{0}_{1}'.format(PREPPED_PREFIX, part)
+        prepped_csvs = ['{0}_{1}.csv'.format(prefix, i)
+                        for i in range(num_shards)]
+        profile_paths = [prepped_csv + '.profile.json'
+                         for prepped_csv in prepped_csvs]
+        zip_path = os.path.join(DOWNLOAD_DIR, filename)
+        if not all(os.path.isfile(prepped_csvs[i]) for i in shards):
+            print("Downloading {0}".format(filename))
+            medicare_csv = download_zip(uri, zip_path)
+            for i in shards:
+                mark_stage(db_dsns[i], part, load_state.DOWNLOADED)
             headers = medicare_csv.readline().replace('"', "").split(",")
             print("Downloaded CSV contains {0} headers.".format(len(headers)))
-            prepped_csv = prep_csv(medicare_csv)
-        print("Loading data into database '{0}' at '{1}'.".format(
-              args.dbname, args.host))
-        load_csv(prepped_csv)
-        print("Altering columns.")
-        alter_col_types()
-        print("Verifying data load.")
-        verify_data_load()
-    except:
-        raise
-    finally:
-        try:
-            print("Deleting temporary data file.")
-            os.remove(prepped_csv)
-        except:
-            pass
+            prep_csv(medicare_csv, num_shards, args.workers, prefix=prefix)
+        profiles = [column_stats.ColumnProfile.load(path)
+                    for path in profile_paths]
+        for i in shards:
+            mark_stage(db_dsns[i], part, load_state.TRANSFORMED,
+                       profiles[i].num_rows)
+        for i in shards:
+            print("Loading {0} into database '{1}', shard {2} of {3}.".format(
+                  part, args.dbname, i + 1, num_shards))
+            load_csv(db_dsns[i], prepped_csvs[i], part, profiles[i])
+        # Every shard has the part now
+        print("Deleting temporary data files.")
+        for path in prepped_csvs + profile_paths + [zip_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+    print("Altering columns.")
+    for dsn in db_dsns:
+        alter_col_types(dsn)
+    print("Verifying data load.")
+    for dsn in db_dsns:
+        verify_shard(dsn)
+    verify_data_load(db_dsns)
+    print("Building county and state rollups.")
+    for dsn in db_dsns:
+        build_rollups(dsn)
+    print("Building age rollup.")
+    for dsn in db_dsns:
+        build_age_rollup(dsn)
+    if args.compact:
+        print("Compacting table.")
+        for dsn in db_dsns:
+            compact_table(dsn)
+    print("Notifying API workers of the new data.")
+    publish_data_version(db_dsn)
@@ -0,0 +1,120 @@
+"""Checkpoints of the data loader, so a failed load can be resumed with
+`data_loader.py --resume` instead of starting over.
+
+Each database the table is loaded into has a load state table with a row
+per part, i.e. per downloaded data file, holding the last stage the part
+reached on that database. Parts that reached STAGES[COPIED] are in the table
+and are skipped when resuming. A part's COPY and its move to the copied stage
+are committed in the same transaction, so a part is never loaded twice.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Stages of a part, in order
+DOWNLOADED = 'downloaded'
+TRANSFORMED = 'transformed'
+COPIED = 'copied'
+VERIFIED = 'verified'
+STAGES = (DOWNLOADED, TRANSFORMED, COPIED, VERIFIED)
+
+
+def state_table(table_name):
+    """Name of the load state table of a table."""
+    return '{0}_load_state'.format(table_name)
+
+
+def create_sql(table_name):
+    """Get the SQL that creates the load state table, if it doesn't exist."""
+    return ("CREATE TABLE IF NOT EXISTS {0} (part VARCHAR(128) PRIMARY KEY, "
+            "stage VARCHAR(16) NOT NULL, num_rows BIGINT, "
+            "updated TIMESTAMP NOT NULL DEFAULT now());".format(
+                state_table(table_name)))
+
+
+def drop_sql(table_name):
+    """Get the SQL that drops the load state table, if it exists."""
+    return "DROP TABLE IF EXISTS {0};".format(state_table(table_name))
+
+
+def reached(stage, target):
+    """
+    Check whether a part's stage is at or past another stage.
+
+    Parameters
+    ----------
+    stage : str, unicode or None
+        The part's stage, or None if it hasn't reached any.
+    target : str, unicode
+        One of STAGES.
+
+    Returns
+    -------
+    bool
+    """
+    return stage is not None and STAGES.index(stage) >= STAGES.index(target)
+
+
+def get_stages(cur, table_name):
+    """
+    Get the stage of every part.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        A cursor on the database holding the load state table.
+    table_name : str, unicode
+        The table being loaded.
+
+    Returns
+    -------
+    dict
+        The stage of each part that has reached one, by part.
+    """
+    cur.execute("SELECT part, stage FROM {0};".format(
+        state_table(table_name)))
+    return dict(cur.fetchall())
+
+
+def set_stage(cur, table_name, part, stage, num_rows=None):
+    """
+    Record the stage a part has reached, in the cursor's transaction.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        A cursor on the database holding the load state table.
+    table_name : str, unicode
+        The table being loaded.
+    part : str, unicode
+        Name of the part.
+    stage : str, unicode
+        One of STAGES.
+    num_rows : int, optional
+        Number of rows of the part in this database, once known. A previous
+        count is kept if this is None.
+    """
+    table = state_table(table_name)
+    cur.execute("UPDATE {0} SET stage = %s, "
+                "num_rows = COALESCE(%s, num_rows), updated = now() "
+                "WHERE part = %s;".format(table), (stage, num_rows, part))
+    if cur.rowcount == 0:
+        cur.execute("INSERT INTO {0} (part, stage, num_rows) "
+                    "VALUES (%s, %s, %s);".format(table),
+                    (part, stage, num_rows))
+
+
+def copied_rows(cur, table_name):
+    """
+    Count the rows of the parts that have been copied, which should be the
+    number of rows in the table.
+
+    Returns
+    -------
+    int
+    """
+    cur.execute("SELECT COALESCE(SUM(num_rows), 0) FROM {0} "
+                "WHERE stage IN (%s, %s);".format(state_table(table_name)),
+                (COPIED, VERIFIED))
+    return int(cur.fetchone()[0])
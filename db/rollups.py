@@ -0,0 +1,91 @@
+"""County and state rollups of the beneficiary table, built by the data loader.
+
+Each rollup row holds, for one county or state, the number of beneficiaries,
+the number with each disease flag and the total of each payment column. The
+county rollup's primary key is (state, county_code), so listing the counties
+of a state is an index lookup, and the state rollup is small enough to read
+whole.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from db import schema
+
+# Metrics of each rollup row, in column order
+METRICS = ('beneficiaries', ) + schema.DISEASE_COLUMNS + \
+    schema.PAYMENT_COLUMNS
+
+
+def county_table(table_name):
+    """Name of the county rollup of a table."""
+    return '{0}_county_rollup'.format(table_name)
+
+
+def state_table(table_name):
+    """Name of the state rollup of a table."""
+    return '{0}_state_rollup'.format(table_name)
+
+
+def create_sql(table_name):
+    """
+    Get the SQL that builds the rollups from a loaded table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        The table to roll up.
+
+    Returns
+    -------
+    list of str, unicode
+        Statements to execute in order.
+    """
+    county = county_table(table_name)
+    state = state_table(table_name)
+    aggregates = ["COUNT(*) AS beneficiaries"]
+    aggregates += ["SUM(CASE WHEN {0} THEN 1 ELSE 0 END)::bigint "
+                   "AS {0}".format(col) for col in schema.DISEASE_COLUMNS]
+    aggregates += ["SUM({0})::bigint AS {0}".format(col)
+                   for col in schema.PAYMENT_COLUMNS]
+    sums = ", ".join("SUM({0})::bigint AS {0}".format(metric)
+                     for metric in METRICS)
+    return [
+        "CREATE TABLE {0} AS SELECT state, county_code, {1} FROM {2} "
+        "GROUP BY state, county_code;".format(county, ", ".join(aggregates),
+                                              table_name),
+        "ALTER TABLE {0} ADD PRIMARY KEY (state, county_code);".format(county),
+        "CREATE TABLE {0} AS SELECT state, {1} FROM {2} "
+        "GROUP BY state;".format(state, sums, county),
+        "ALTER TABLE {0} ADD PRIMARY KEY (state);".format(state),
+        "ANALYZE {0};".format(county),
+        "ANALYZE {0};".format(state),
+    ]
+
+
+def drop_sql(table_name):
+    """
+    Get the SQL that drops the rollups, if they exist.
+
+    Returns
+    -------
+    list of str, unicode
+    """
+    return ["DROP TABLE IF EXISTS {0};".format(county_table(table_name)),
+            "DROP TABLE IF EXISTS {0};".format(state_table(table_name))]
+
+
+def states_sql(table_name):
+    """Query returning the rollup row of every state."""
+    return "SELECT state, {0} FROM {1}".format(", ".join(METRICS),
+                                               state_table(table_name))
+
+
+def counties_sql(table_name):
+    """
+    Query returning the rollup row of every county in a state, taking the
+    state as its only parameter.
+    """
+    return "SELECT county_code, {0} FROM {1} WHERE state = %s".format(
+        ", ".join(METRICS), county_table(table_name))
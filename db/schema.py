@@ -0,0 +1,127 @@
+"""Column definitions of the beneficiary table, shared by the server and data
+loader so that user-supplied column names and values can be validated.
+
+The order of `COLUMNS` matches the column order of the CSV files prepared by
+`data_loader.prep_csv()` and of the table created by
+`data_loader.create_table()`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+# Kinds of column, used to validate and convert filter values
+CHAR = 'char'
+DATE = 'date'
+SEX = 'sex'
+RACE = 'race'
+BOOLEAN = 'boolean'
+STATE = 'state'
+INTEGER = 'integer'
+
+SEX_VALUES = ('male', 'female')
+RACE_VALUES = ('white', 'black', 'others', 'hispanic')
+# '__' is what the data loader stores for the two SSA state codes that aren't
+# used (40 and 48), so the rows that have it can still be filtered on
+STATE_VALUES = ('AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC',
+                'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY',
+                'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT',
+                'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH',
+                'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX',
+                'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY', 'Othr', '__')
+
+COLUMNS = OrderedDict([
+    ("id", CHAR),
+    ("dob", DATE),
+    ("dod", DATE),
+    ("sex", SEX),
+    ("race", RACE),
+    ("end_stage_renal_disease", BOOLEAN),
+    ("state", STATE),
+    ("county_code", INTEGER),
+    ("part_a_coverage_months", INTEGER),
+    ("part_b_coverage_months", INTEGER),
+    ("hmo_coverage_months", INTEGER),
+    ("part_d_coverage_months", INTEGER),
+    ("alzheimers_related_senile", BOOLEAN),
+    ("heart_failure", BOOLEAN),
+    ("chronic_kidney", BOOLEAN),
+    ("cancer", BOOLEAN),
+    ("chronic_obstructive_pulmonary", BOOLEAN),
+    ("depression", BOOLEAN),
+    ("diabetes", BOOLEAN),
+    ("ischemic_heart", BOOLEAN),
+    ("osteoporosis", BOOLEAN),
+    ("rheumatoid_osteo_arthritis", BOOLEAN),
+    ("stroke_ischemic_attack", BOOLEAN),
+    ("inpatient_reimbursement", INTEGER),
+    ("inpatient_beneficiary_responsibility", INTEGER),
+    ("inpatient_primary_payer_reimbursement", INTEGER),
+    ("outpatient_reimbursement", INTEGER),
+    ("outpatient_beneficiary_responsibility", INTEGER),
+    ("outpatient_primary_payer_reimbursement", INTEGER),
+    ("carrier_reimbursement", INTEGER),
+    ("beneficiary_responsibility", INTEGER),
+    ("primary_payer_reimbursement", INTEGER),
+])
+
+# The 12 chronic condition flags
+DISEASE_COLUMNS = tuple(col for col, kind in COLUMNS.items()
+                        if kind == BOOLEAN)
+
+# The 9 reimbursement and responsibility amounts
+PAYMENT_COLUMNS = tuple(col for col in COLUMNS
+                        if col.endswith(('reimbursement', 'responsibility')))
+
+
+def convert_value(col, value):
+    """
+    Convert a string value supplied by a user to the Python type of a column.
+
+    Parameters
+    ----------
+    col : str, unicode
+        The name of a column in `COLUMNS`.
+    value : str, unicode
+        The raw value, e.g. from a query string.
+
+    Returns
+    -------
+    object
+        The value converted to a type psycopg2 can adapt for the column.
+
+    Raises
+    ------
+    ValueError
+        If the column does not exist or the value is not valid for it.
+    """
+    if col not in COLUMNS:
+        raise ValueError("column '{0}' does not exist".format(col))
+    kind = COLUMNS[col]
+    if kind == BOOLEAN:
+        lowered = value.lower()
+        if lowered in ('true', 't', '1'):
+            return True
+        if lowered in ('false', 'f', '0'):
+            return False
+    elif kind == INTEGER:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    elif kind == SEX and value in SEX_VALUES:
+        return value
+    elif kind == RACE and value in RACE_VALUES:
+        return value
+    elif kind == STATE and value in STATE_VALUES:
+        return value
+    elif kind == DATE and len(value) == 10:
+        # ISO formatted date, YYYY-MM-DD
+        if value[:4].isdigit() and value[5:7].isdigit() and \
+                value[8:].isdigit():
+            return value
+    elif kind == CHAR and len(value) <= 16:
+        return value
+    raise ValueError("invalid value '{0}' for column '{1}'".format(value, col))
@@ -64,6 +64,7 @@ def vagrant():
     env.dbname = awsconfig.vagrant_dbname
     env.dbuser = awsconfig.vagrant_dbuser
     env.dbpass = awsconfig.vagrant_dbpass
+    env.dbshards = awsconfig.vagrant_shard_hosts
 
 
 def aws():
@@ -81,6 +82,7 @@ def aws():
     env.dbname = awsconfig.rds_dbname
     env.dbuser = awsconfig.rds_dbuser
     env.dbpass = awsconfig.rds_dbpass
+    env.dbshards = awsconfig.rds_shard_hosts
 
 
 def ssh():
@@ -217,6 +219,13 @@ def sub_load_db():
     if env.dbpass is not None:
         password = "--password %(dbpass)s" % env
         db_load_command = ' '.join([db_load_command, password])
+    # Store the table in the compact layout if configured
+    if awsconfig.db_compact:
+        db_load_command = ' '.join([db_load_command, "--compact"])
+    # Shard the table across the configured hosts, if any
+    if env.dbshards:
+        shards = "--shards %s" % ','.join(env.dbshards)
+        db_load_command = ' '.join([db_load_command, shards])
     # Need to put together entire command to activate virtualenv first
     activate_venv = "cd %(base)s/%(virtualenv)s; source bin/activate;" % env
     command = ' '.join([activate_venv, db_load_command])
@@ -1,39 +1,192 @@
 """Flask-based JSON API to Medicare claims data: please see the repository
 https://github.com/nsh87/medicare-claims-query-api for more info.
+
+The app is made by `create_app()`; see wsgi.py for the Gunicorn entry point.
+Importing this module only defines the API, so it stays fast: the locale, DB
+settings and query registry are set up by `create_app()`, connections are
+made on first use, and pyarrow and pyroaring are imported when first needed.
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import csv
+import datetime
+import decimal
+import functools
+import heapq
+import itertools
+import json
 import locale
 import os
+import threading
+import time
 
 import psycopg2
-import psycopg2.extras
-from flask import Flask, jsonify
+from concurrent.futures import ThreadPoolExecutor, wait
+from psycopg2.extensions import QueryCanceledError
+from flask import Blueprint, Flask, Response, jsonify, request
 from collections import OrderedDict
 
 import re
 
 re.sub
 
-from core.utilities import cursor_connect
+from core import columnar
+from core.admission import AdmissionController, AdmissionLimit, Overloaded
+from core.cache import ResultCache
+from core.jobs import JobManager
+from core.notify import DataVersionListener, current_version
+from core.profiling import QueryProfiler
+from core.routing import ReplicaRouter, make_dsn
+from core.sharding import (ShardSet, merge_average, merge_counts,
+                           merge_frequency, merge_sums, merge_total)
+from core.statements import StatementRegistry
+from core.utilities import (QueriesCancelled, QueryGroup, cursor_connect,
+                            pooled_cursor)
+from db import ages
+from db import column_stats
+from db import compact
 from db import config as dbconfig
+from db import rollups
+from db import schema
 
-app = Flask(__name__)
+api = Blueprint('api', __name__)
 
 TABLE_NAME = dbconfig.db_tablename
 
-locale.setlocale(locale.LC_ALL, '')  # For formatting numbers with commas
+# Rows fetched from the server-side cursor at a time when exporting rows
+ROWS_BATCH_SIZE = 10000
+# Default and maximum number of rows returned by one /api/v1/rows request
+ROWS_DEFAULT_LIMIT = 100000
+ROWS_MAX_LIMIT = 5000000
+
+# Default and maximum number of states or counties returned by one request
+GEO_DEFAULT_LIMIT = 100
+GEO_MAX_LIMIT = 1000
+
+# Connections kept open to each DB node by each worker, and seconds between
+# health checks of the nodes
+DB_POOL_MIN = 1
+DB_POOL_MAX = 16
+DB_HEALTH_INTERVAL = 5
+db_shards = None
+db_shards_lock = threading.Lock()
+
+# Only allow average value computation on certain (numeric) columns
+AVERAGE_COLUMNS = (
+    "inpatient_reimbursement",
+    "inpatient_beneficiary_responsibility",
+    "inpatient_primary_payer_reimbursement",
+    "outpatient_reimbursement",
+    "outpatient_beneficiary_responsibility",
+    "outpatient_primary_payer_reimbursement",
+    "carrier_reimbursement",
+    "beneficiary_responsibility",
+    "primary_payer_reimbursement",
+    "part_a_coverage_months",
+    "part_b_coverage_months",
+    "hmo_coverage_months",
+    "part_d_coverage_months",
+)
+
+# How many requests to each endpoint may run and queue at once, how long they
+# may queue, and the statement_timeout (milliseconds) of their queries
+ADMISSION_LIMITS = {
+    'index': AdmissionLimit(concurrency=8, queue_size=16, queue_timeout=0.5,
+                            statement_timeout=5000),
+    'get_counts': AdmissionLimit(concurrency=4, queue_size=8,
+                                 queue_timeout=1, statement_timeout=20000),
+    'get_average': AdmissionLimit(concurrency=4, queue_size=8,
+                                  queue_timeout=1, statement_timeout=20000),
+    'disease_frequency': AdmissionLimit(concurrency=2, queue_size=4,
+                                        queue_timeout=1,
+                                        statement_timeout=30000),
+    'get_rows': AdmissionLimit(concurrency=2, queue_size=2, queue_timeout=0.5,
+                               statement_timeout=60000),
+    'get_cohort': AdmissionLimit(concurrency=8, queue_size=16,
+                                 queue_timeout=1),
+    'jobs': AdmissionLimit(concurrency=8, queue_size=16, queue_timeout=1,
+                           statement_timeout=3600000),
+    'geo_states': AdmissionLimit(concurrency=8, queue_size=16,
+                                 queue_timeout=0.5, statement_timeout=5000),
+    'geo_counties': AdmissionLimit(concurrency=8, queue_size=16,
+                                   queue_timeout=0.5, statement_timeout=5000),
+    'age_distribution': AdmissionLimit(concurrency=8, queue_size=16,
+                                       queue_timeout=0.5,
+                                       statement_timeout=5000),
+    'age_mortality': AdmissionLimit(concurrency=8, queue_size=16,
+                                    queue_timeout=0.5, statement_timeout=5000),
+    # Profiling runs on the profiler's own thread, so this only sets their
+    # statement timeout, and counts their cancels apart from user requests
+    'profile': AdmissionLimit(concurrency=1, queue_size=0, queue_timeout=0,
+                              statement_timeout=60000),
+}
+DEFAULT_ADMISSION_LIMIT = AdmissionLimit(concurrency=4, queue_size=8,
+                                         queue_timeout=1,
+                                         statement_timeout=30000)
+admission = AdmissionController(ADMISSION_LIMITS, DEFAULT_ADMISSION_LIMIT)
+
+# Results of the statements in the registry, by (endpoint, column)
+result_cache = ResultCache()
+
+# Endpoints whose results are computed before a worker takes traffic, and the
+# time and threads the warm-up may use
+WARMUP_ENDPOINTS = ('index', 'get_counts', 'get_average', 'disease_frequency')
+WARMUP_BUDGET = 120  # Seconds
+WARMUP_WORKERS = 4
+warmup_status = {
+    'ready': False,
+    'started': None,
+    'finished': None,
+    'warmed': 0,
+    'failed': 0,
+    'total': 0,
+}
 
-# Default to connect to production environment, override later if dev server
-try:
-    db_dsn = "host={0} dbname={1} user={2} password={3}".format(
-        dbconfig.rds_dbhost, dbconfig.rds_dbname, dbconfig.rds_dbuser,
-        dbconfig.rds_dbpass)
-except ValueError:
-    pass
+# Background jobs: how many run at once, how long finished jobs are kept
+# (seconds), and the most columns a group-by job may have. Jobs are kept in
+# the worker's memory, so this assumes a single Gunicorn worker process.
+JOB_WORKERS = 2
+JOB_TTL = 3600
+JOB_GROUP_BY_MAX_COLUMNS = 4
+# Job types that run the query of an endpoint, and the endpoint they run
+JOB_ENDPOINTS = {
+    'count': 'get_counts',
+    'average': 'get_average',
+    'freq': 'disease_frequency',
+}
+
+# Profiling of the count, average and frequency queries: the number of the
+# slowest profiles kept. It is off unless `create_app()` is given a sample
+# rate, and /api/v1/admin/profile only exists while it is on.
+PROFILE_CAPACITY = 50
+profiler = QueryProfiler(capacity=PROFILE_CAPACITY)
+
+# Whether a worker warms its caches up again as soon as it hears that the
+# table was reloaded, rather than letting requests fill them
+REWARM_ON_RELOAD = True
+# Seconds a worker waits after a reload for the read replicas to replay it,
+# before it drops its caches and reads the new data
+RELOAD_REPLICA_WAIT = 120
+# Listener for reloads of the table, started in each worker process
+data_listener = None
+# Data version the caches were filled from, read by `warm_up()` and inherited
+# by the workers
+data_version = None
+
+# Bitmap index for /api/v1/cohort, built from the table on first use
+cohort_index = None
+cohort_index_lock = threading.Lock()
+
+# DSNs of the databases, set by `configure_databases()`
+db_dsn = None
+replica_dsns = []
+shard_dsns = []
+
+# Registry of query shapes, set by `create_app()`
+statements = None
 
 
 def json_error(code, err):
@@ -57,7 +210,753 @@ def json_error(code, err):
     return response
 
 
-@app.route('/')
+class _LineBuffer(object):
+    """
+    A minimal file-like object that collects the lines written by a
+    `csv.writer` so they can be yielded in a streaming response.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def drain(self):
+        data = ''.join(self.lines)
+        self.lines = []
+        return data
+
+
+def negotiate_format():
+    """
+    Pick the response format from the `format` query parameter, or failing
+    that from the request's Accept header.
+
+    Returns
+    -------
+    str, unicode or None
+        One of 'json', `columnar.ARROW` or `columnar.PARQUET`, or None if none
+        of them are acceptable to the client.
+    """
+    fmt = request.args.get('format')
+    if fmt:
+        if fmt in ('json', columnar.ARROW, columnar.PARQUET):
+            return fmt
+        return None
+    mimetypes = OrderedDict([
+        ('application/json', 'json'),
+        (columnar.MIMETYPES[columnar.ARROW], columnar.ARROW),
+        (columnar.MIMETYPES[columnar.PARQUET], columnar.PARQUET),
+    ])
+    best = request.accept_mimetypes.best_match(list(mimetypes),
+                                               default='application/json')
+    return mimetypes.get(best)
+
+
+def columnar_response(fields, rows, fmt):
+    """
+    Make an Arrow or Parquet response from the rows of a query result.
+
+    Parameters
+    ----------
+    fields : list of tuple
+        A (name, kind) tuple for each column of the result, where kind is a
+        column kind accepted by `columnar.arrow_type()`.
+    rows : list of tuple
+        The result rows, e.g. from `cursor.fetchall()`.
+    fmt : {'arrow', 'parquet'}
+        The format to return.
+
+    Returns
+    -------
+    response
+        A response containing the serialized result.
+    """
+    names = [name for name, _ in fields]
+    kinds = [kind for _, kind in fields]
+    batch = columnar.record_batch(names, kinds, rows)
+    return Response(columnar.stream_batches([batch], batch.schema, fmt),
+                    mimetype=columnar.MIMETYPES[fmt])
+
+
+def get_shards():
+    """
+    Get the worker's shards of the table, creating their routers on first use
+    so that `db_dsn`, `replica_dsns` and `shard_dsns` can be overridden before
+    any connection is made.
+
+    If `shard_dsns` is empty the table is not sharded, and the single shard
+    is the primary and its replicas.
+
+    Returns
+    -------
+    core.sharding.ShardSet
+    """
+    global db_shards
+    if db_shards is None:
+        with db_shards_lock:
+            if db_shards is None:
+                if shard_dsns:
+                    routers = [ReplicaRouter(dsn, [], DB_POOL_MIN, DB_POOL_MAX)
+                               for dsn in shard_dsns]
+                else:
+                    routers = [ReplicaRouter(db_dsn, replica_dsns, DB_POOL_MIN,
+                                             DB_POOL_MAX)]
+                for router in routers:
+                    router.start_health_checks(DB_HEALTH_INTERVAL)
+                # As many scatters at once as each shard has connections,
+                # so concurrent requests don't queue behind each other
+                db_shards = ShardSet(routers, concurrency=DB_POOL_MAX)
+    return db_shards
+
+
+def configure_databases(dev=False):
+    """
+    Set the DSNs of the primary, replica and shard databases from
+    db/config.py.
+
+    Parameters
+    ----------
+    dev : bool
+        Use the Vagrant databases instead of RDS.
+    """
+    global db_dsn, replica_dsns, shard_dsns
+    if dev:
+        host, name, user, password = (
+            dbconfig.vagrant_dbhost, dbconfig.vagrant_dbname,
+            dbconfig.vagrant_dbuser, dbconfig.vagrant_dbpass)
+        replica_hosts = dbconfig.vagrant_replica_hosts
+        shard_hosts = dbconfig.vagrant_shard_hosts
+    else:
+        host, name, user, password = (
+            dbconfig.rds_dbhost, dbconfig.rds_dbname, dbconfig.rds_dbuser,
+            dbconfig.rds_dbpass)
+        replica_hosts = dbconfig.rds_replica_hosts
+        shard_hosts = dbconfig.rds_shard_hosts
+    db_dsn = make_dsn(host, name, user, password)
+    replica_dsns = [make_dsn(h, name, user, password) for h in replica_hosts]
+    shard_dsns = [make_dsn(h, name, user, password) for h in shard_hosts]
+
+
+def reset_connections(close=True):
+    """
+    Discard the worker's connection pools and health check threads, so they
+    are created again on first use.
+
+    Gunicorn calls this in the master after warming up, before it forks the
+    workers, so that no worker inherits connections that are shared with
+    another process.
+
+    Parameters
+    ----------
+    close : bool
+        Close the pools' connections. Pass False in a forked child, whose
+        inherited connections must be left to the parent.
+    """
+    global db_shards
+    with db_shards_lock:
+        if db_shards is not None and close:
+            db_shards.close()
+        db_shards = None
+
+
+def build_statements():
+    """
+    Register the query shape of every endpoint and allowed column.
+
+    Each query computes a partial aggregate that can be merged across shards,
+    e.g. a sum and a count instead of an average. If the table was loaded in
+    the compact layout (`db_compact` in db/config.py), the queries scan its
+    narrow tables instead of the full-width view. If the loader stored column
+    stats (`db_column_stats`), the row count, the value counts of categorical
+    columns and the averages are read from them without scanning the table.
+
+    Returns
+    -------
+    StatementRegistry
+    """
+    if dbconfig.db_compact:
+        total_sql = lambda col: compact.total_sql(TABLE_NAME)
+        count_sql = lambda col: compact.count_sql(col, TABLE_NAME)
+        average_sql = lambda col: compact.average_sql(col, TABLE_NAME)
+        frequency_sql = lambda col: compact.frequency_sql(col, TABLE_NAME)
+    else:
+        total_sql = lambda col: "SELECT COUNT(*) FROM {0}".format(TABLE_NAME)
+        count_sql = lambda col: ("SELECT {0}, COUNT(*) AS num FROM {1} "
+                                 "GROUP BY {0}".format(col, TABLE_NAME))
+        average_sql = lambda col: ("SELECT SUM({0}) AS total, COUNT({0}) AS "
+                                   "num FROM {1}".format(col, TABLE_NAME))
+        frequency_sql = lambda col: (
+            "SELECT state, COUNT(*) AS claims, "
+            "SUM(CASE WHEN {0} THEN 1 ELSE 0 END) AS cases "
+            "FROM {1} GROUP BY state".format(col, TABLE_NAME))
+    if dbconfig.db_column_stats:
+        scan_count_sql = count_sql
+        total_sql = lambda col: column_stats.total_sql(TABLE_NAME)
+        count_sql = lambda col: (
+            column_stats.count_sql(col, TABLE_NAME)
+            if col in column_stats.COUNTED_COLUMNS else scan_count_sql(col))
+        average_sql = lambda col: column_stats.average_sql(col, TABLE_NAME)
+    registry = StatementRegistry()
+    registry.register(
+        'index',
+        total_sql,
+        merge=merge_total,
+        names=lambda col: ('count', ))
+    registry.register(
+        'get_counts',
+        count_sql,
+        [col for col in schema.COLUMNS if col != 'id'],
+        merge=merge_counts,
+        names=lambda col: (col, 'num'))
+    registry.register(
+        'get_average',
+        average_sql,
+        AVERAGE_COLUMNS,
+        merge=merge_average,
+        names=lambda col: ('avg', ))
+    registry.register(
+        'disease_frequency',
+        frequency_sql,
+        schema.DISEASE_COLUMNS,
+        merge=merge_frequency,
+        names=lambda col: ('state', 'frequency'))
+    return registry
+
+
+def admitted(endpoint):
+    """
+    Decorate a view so it only runs once admission control lets it.
+
+    Parameters
+    ----------
+    endpoint : str, unicode
+        Name of the endpoint whose limits apply.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with admission.admit(endpoint):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_statement_timeout(con, endpoint):
+    """
+    Apply the statement timeout of an endpoint to the current transaction of
+    a connection.
+
+    Parameters
+    ----------
+    con : psycopg2.extensions.connection
+        A connection that isn't in autocommit mode.
+    endpoint : str, unicode
+        Name of the endpoint whose limits apply.
+    """
+    timeout = admission.limit(endpoint).statement_timeout
+    if timeout is not None:
+        cur = con.cursor()
+        cur.execute("SET LOCAL statement_timeout = %s", (timeout, ))
+        cur.close()
+
+
+def query_shards(endpoint, execute, queries=None):
+    """
+    Run a query on every shard in parallel.
+
+    Parameters
+    ----------
+    endpoint : str, unicode
+        Name of the endpoint whose statement timeout applies.
+    execute : callable
+        Called with a cursor on each shard to execute the query.
+    queries : core.utilities.QueryGroup, optional
+        A group to add each shard's connection to while its query runs, so
+        the query can be cancelled.
+
+    Returns
+    -------
+    list of list of tuple
+        The rows returned by each shard, in shard order.
+
+    Raises
+    ------
+    Overloaded
+        If a query was cancelled by the endpoint's statement timeout.
+    QueryCanceledError, QueriesCancelled
+        If `queries` was cancelled.
+    """
+    def query(cur):
+        set_statement_timeout(cur.connection, endpoint)
+        execute(cur)
+        return cur.fetchall()
+
+    def run(router):
+        with router.read_cursor() as cur:
+            if queries is None:
+                return query(cur)
+            # Leave the group before the connection goes back to the pool
+            with queries.running_on(cur.connection):
+                return query(cur)
+
+    try:
+        return get_shards().scatter(run)
+    except QueryCanceledError:
+        if queries is not None and queries.cancelled:
+            raise
+        admission.record_cancel(endpoint)
+        raise Overloaded(endpoint, admission.limit(endpoint).retry_after)
+
+
+def run_statement(statement, queries=None, endpoint=None):
+    """
+    Get the result of a statement from the result cache, querying every shard
+    and merging their results on a miss.
+
+    Parameters
+    ----------
+    statement : core.statements.Statement
+        A statement from the registry.
+    queries : core.utilities.QueryGroup, optional
+        Passed to `query_shards()`.
+    endpoint : str, unicode, optional
+        Name of the endpoint whose statement timeout applies, and whose
+        cancels are counted, if not the statement's, e.g. 'jobs'.
+
+    Returns
+    -------
+    list of tuple
+        The merged rows, which must not be modified since they are shared.
+
+    Raises
+    ------
+    Overloaded
+        If the query was cancelled by the endpoint's statement timeout.
+    """
+    key = (statement.endpoint, statement.col)
+    generation = result_cache.generation
+    result = result_cache.get(key)
+    if result is None:
+        partials = query_shards(
+            endpoint or statement.endpoint,
+            lambda cur: statements.execute(cur, statement),
+            queries)
+        result = statement.merge(partials)
+        result_cache.set(key, result, generation)
+    return result
+
+
+def profile(statement):
+    """
+    Profile a statement with EXPLAIN ANALYZE on every shard, in the
+    background, if the request is sampled by the profiler. The queries run
+    under the 'profile' limits, not those of the statement's endpoint.
+
+    Parameters
+    ----------
+    statement : core.statements.Statement
+        The statement the request runs.
+    """
+    profiler.sample(statement, lambda: [
+        rows[0][0] for rows in query_shards(
+            'profile', lambda cur: statements.explain(cur, statement))])
+
+
+def warm_up(budget=WARMUP_BUDGET, workers=WARMUP_WORKERS, heartbeat=None):
+    """
+    Fill the result cache for every allowed column of every endpoint in
+    WARMUP_ENDPOINTS, and build the cohort index, using parallel queries.
+
+    When the time budget runs out, statements that haven't started are
+    skipped and running queries are cancelled; they will be cached by the
+    first request for them instead. This only returns once no warm-up thread
+    is left running, so Gunicorn never forks while one holds a lock or a
+    pooled connection. `warmup_status['ready']` is set once the warm-up is
+    over either way, and stays set if the caches are warmed up again after a
+    reload.
+
+    Parameters
+    ----------
+    budget : float
+        Maximum number of seconds to wait for the warm-up.
+    workers : int
+        Number of queries to run at once. Must be no more than DB_POOL_MAX.
+    heartbeat : callable, optional
+        Called about once a second while waiting, e.g. to tell the Gunicorn
+        arbiter that the worker is still alive.
+    """
+    global data_version
+    started = time.time()
+    deadline = started + budget
+    # Read before any query, so a reload during the warm-up isn't missed
+    data_version = read_data_version()
+    shapes = [statements.get(endpoint, col)
+              for endpoint in WARMUP_ENDPOINTS
+              for col in statements.columns(endpoint) or [None]]
+    warmup_status.update(started=started, finished=None, warmed=0, failed=0,
+                         total=len(shapes) + 1)
+    lock = threading.Lock()
+    queries = QueryGroup()
+
+    def warm(task, *args):
+        if time.time() > deadline:
+            return
+        try:
+            task(*args)
+        except (psycopg2.Error, ValueError, Overloaded, QueriesCancelled):
+            outcome = 'failed'
+        else:
+            outcome = 'warmed'
+        with lock:
+            warmup_status[outcome] += 1
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(warm, get_cohort_index, queries)]
+    futures.extend(executor.submit(warm, run_statement, statement, queries)
+                   for statement in shapes)
+    while time.time() < deadline:
+        done, not_done = wait(futures, timeout=1)
+        if heartbeat is not None:
+            heartbeat()
+        if not not_done:
+            break
+    for future in futures:
+        future.cancel()
+    queries.cancel()
+    executor.shutdown(wait=True)
+    warmup_status.update(ready=True, finished=time.time())
+
+
+def reload_data(version):
+    """
+    Drop everything the worker has computed from the table, after the data
+    loader has reloaded it, and warm the caches up again if REWARM_ON_RELOAD.
+
+    The caches are only dropped once the read replicas have replayed the
+    reload (see `wait_for_replicas()`), so they aren't filled again from a
+    replica that still has the old data.
+
+    Called on the listener's thread, see `listen_for_reloads()`. Prepared
+    statements don't need to be dropped, since Postgres plans them again
+    once the tables they use have changed.
+
+    Parameters
+    ----------
+    version : str, unicode or None
+        The new data version, or None if the loader didn't store one.
+    """
+    global cohort_index, data_version
+    if version is not None:
+        wait_for_replicas(version)
+    data_version = version
+    result_cache.clear()
+    cohort_index = None
+    jobs.forget_results()
+    if REWARM_ON_RELOAD:
+        warm_up()
+
+
+def wait_for_replicas(version, timeout=RELOAD_REPLICA_WAIT):
+    """
+    Wait until every healthy read replica stores a data version, i.e. has
+    replayed the load that published it.
+
+    Parameters
+    ----------
+    version : str, unicode
+        The version published on the primary.
+    timeout : float
+        Maximum number of seconds to wait.
+
+    Returns
+    -------
+    bool
+        Whether every healthy replica caught up in time. Replicas that didn't
+        are still read from.
+    """
+    def replica_version(node):
+        try:
+            with pooled_cursor(node.pool) as cur:
+                return current_version(cur)
+        except psycopg2.Error:
+            return None
+
+    deadline = time.time() + timeout
+    pending = [node for router in get_shards().routers
+               for node in router.replicas]
+    while True:
+        # Unhealthy replicas don't take reads, so they aren't waited for
+        pending = [node for node in pending
+                   if node.healthy and replica_version(node) != version]
+        if not pending or time.time() >= deadline:
+            return not pending
+        time.sleep(1)
+
+
+def read_data_version():
+    """
+    Get the latest data version the loader published.
+
+    Returns
+    -------
+    str, unicode or None
+        The version, or None if none was published or the primary database
+        can't be reached.
+    """
+    try:
+        con, cur = cursor_connect(db_dsn)
+    except psycopg2.Error:
+        return None
+    try:
+        return current_version(cur)
+    except psycopg2.Error:
+        return None
+    finally:
+        con.close()
+
+
+def listen_for_reloads():
+    """
+    Start listening for reloads of the table on a background thread, see
+    `core.notify`.
+
+    Threads don't survive a fork, so Gunicorn calls this in each worker
+    after it is forked. The listener starts from `data_version`, so a worker
+    forked after a reload the master never heard of drops the caches it
+    inherited as soon as the listener connects.
+    """
+    global data_listener
+    if data_listener is None:
+        data_listener = DataVersionListener(db_dsn, reload_data,
+                                            version=data_version)
+        data_listener.start()
+
+
+def get_cohort_index(queries=None):
+    """
+    Get the cohort bitmap index, building it if it hasn't been built yet.
+
+    Parameters
+    ----------
+    queries : core.utilities.QueryGroup, optional
+        A group to add the connections of the build to, so it can be
+        cancelled.
+
+    Returns
+    -------
+    CohortIndex
+        The index, shared by all threads of the worker.
+    """
+    global cohort_index
+    index = cohort_index
+    if index is None:
+        with cohort_index_lock:
+            index = cohort_index
+            if index is None:
+                from core.cohort import CohortIndex
+                generation = result_cache.generation
+                connections = []
+                try:
+                    for router in get_shards().routers:
+                        con, cur = cursor_connect(router.pick().dsn,
+                                                  name='cohort_index')
+                        cur.itersize = ROWS_BATCH_SIZE
+                        connections.append((con, cur))
+                        if queries is not None:
+                            queries.add(con)
+                    index = CohortIndex.build(
+                        [cur for _, cur in connections], TABLE_NAME,
+                        queries=queries)
+                finally:
+                    for con, cur in connections:
+                        if queries is not None:
+                            queries.discard(con)
+                        # Also closes the cursor, even if its query failed
+                        con.close()
+                # Don't keep an index of the old data if the table was
+                # reloaded while it was built
+                if generation == result_cache.generation:
+                    cohort_index = index
+    return index
+
+
+@api.app_errorhandler(Overloaded)
+def overloaded(e):
+    """Reject a request that wasn't admitted with a 503 and Retry-After."""
+    response = json_error(503, str(e))
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@api.after_request
+def add_etag(response):
+    """
+    Tag successful GET responses with an ETag of their body, and answer a
+    request whose If-None-Match matches it with an empty 304, so clients
+    that cached the result don't download it again.
+
+    Streamed responses are left alone, since tagging them would mean holding
+    the whole body in memory.
+    """
+    if request.method == 'GET' and response.status_code == 200 and \
+            not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def filter_conditions(filters):
+    """
+    Make SQL conditions for equality filters on columns of the table.
+
+    Parameters
+    ----------
+    filters : dict
+        Raw string values to match, by column name. A column with several
+        values matches any of them.
+
+    Returns
+    -------
+    (list, list)
+        The conditions, to be joined with AND, and the query parameters they
+        use.
+
+    Raises
+    ------
+    ValueError
+        If a column doesn't exist or a value isn't valid for its column.
+    """
+    conditions = []
+    params = []
+    for col in sorted(filters):
+        values = [schema.convert_value(col, value) for value in filters[col]]
+        if len(values) == 1:
+            conditions.append("{0} = %s".format(col))
+            params.append(values[0])
+        else:
+            conditions.append("{0} IN %s".format(col))
+            params.append(tuple(values))
+    return conditions, params
+
+
+def _jsonable(value):
+    """Convert DATE and NUMERIC values so `jsonify` can serialize them."""
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def validate_job(body):
+    """
+    Validate the query of a job submitted to /api/v1/jobs.
+
+    Parameters
+    ----------
+    body : dict
+        The submitted JSON. Either {"type": "count" | "average" | "freq",
+        "col": <column>}, or {"type": "group_by", "cols": [<column>, ...],
+        "filters": {<column>: <value> | [<value>, ...]}} where filters are
+        optional.
+
+    Returns
+    -------
+    dict
+        The query in a normalized form, so identical queries are equal.
+
+    Raises
+    ------
+    ValueError
+        If the query is not valid.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("job must be a JSON object")
+    job_type = body.get('type')
+    if job_type in JOB_ENDPOINTS:
+        col = body.get('col')
+        if not isinstance(col, basestring) or \
+                statements.get(JOB_ENDPOINTS[job_type], col) is None:
+            raise ValueError("column '{0}' is not allowed".format(col))
+        return {'type': job_type, 'col': col}
+    if job_type != 'group_by':
+        raise ValueError("unknown job type '{0}'".format(job_type))
+    cols = body.get('cols')
+    if not isinstance(cols, list) or \
+            not 0 < len(cols) <= JOB_GROUP_BY_MAX_COLUMNS:
+        raise ValueError("cols must be a list of 1 to {0} columns".format(
+                         JOB_GROUP_BY_MAX_COLUMNS))
+    for col in cols:
+        if not isinstance(col, basestring) or col not in schema.COLUMNS or \
+                col == 'id':
+            raise ValueError("column '{0}' is not allowed".format(col))
+    if len(set(cols)) != len(cols):
+        raise ValueError("cols must not repeat a column")
+    filters = body.get('filters') or {}
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be a JSON object")
+    normalized_filters = {}
+    for col, values in filters.items():
+        if not isinstance(values, list):
+            values = [values]
+        if not values:
+            raise ValueError("filter on '{0}' has no values".format(col))
+        normalized_filters[col] = sorted(
+            '{0}'.format(value).lower() if isinstance(value, bool)
+            else '{0}'.format(value) for value in values)
+    filter_conditions(normalized_filters)  # Raises ValueError if not valid
+    return {'type': 'group_by', 'cols': cols, 'filters': normalized_filters}
+
+
+def run_job(job):
+    """
+    Run the query of a job on a pooled connection, with the statement timeout
+    of the 'jobs' endpoint rather than that of the interactive endpoint the
+    query shape belongs to.
+
+    Parameters
+    ----------
+    job : core.jobs.Job
+        A job whose spec came from `validate_job()`.
+
+    Returns
+    -------
+    list of dict
+        The result rows, keyed by column name.
+    """
+    spec = job.spec
+    if spec['type'] in JOB_ENDPOINTS:
+        statement = statements.get(JOB_ENDPOINTS[spec['type']], spec['col'])
+        result = run_statement(statement, job.queries, endpoint='jobs')
+        names = statement.names
+    else:
+        conditions, params = filter_conditions(spec['filters'])
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        query = ("SELECT {0}, COUNT(*) AS num FROM {1} {2} "
+                 "GROUP BY {0};".format(", ".join(spec['cols']), TABLE_NAME,
+                                        where))
+        partials = query_shards('jobs', lambda cur: cur.execute(query, params),
+                                job.queries)
+        result = merge_counts(partials)
+        names = spec['cols'] + ['num']
+    return [dict(zip(names, [_jsonable(val) for val in row]))
+            for row in result]
+
+
+jobs = JobManager(run_job, JOB_WORKERS, JOB_TTL)
+
+
+def _json_default(obj):
+    """Serialize the DATE columns, which `json.dumps` can't handle."""
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+@api.route('/')
+@admitted('index')
 def index():
     """
     Main page with no JSON API, just a short message about number of rows
@@ -71,12 +970,9 @@ def index():
     """
     num_rows = 0  # Default value
     try:
-        con, cur = cursor_connect(db_dsn)
-        sql = "SELECT COUNT(*) FROM {0}".format(TABLE_NAME)
-        cur.execute(sql)
-        result = cur.fetchone()
-        num_rows = int(result[0])
-    except (psycopg2.Error, ValueError) as e:
+        result = run_statement(statements.get('index'))
+        num_rows = int(result[0][0])
+    except (psycopg2.Error, ValueError, Overloaded) as e:
         num_rows = 0
     finally:
         html = """
@@ -118,7 +1014,8 @@ def index():
         return html
 
 
-@app.route('/api/v1/count/<col>')
+@api.route('/api/v1/count/<col>')
+@admitted('get_counts')
 def get_counts(col):
     """
     Get counts of distinct values in the available columns.
@@ -140,25 +1037,31 @@ def get_counts(col):
     """
     count = {}
     cleaned_col = re.sub('\W+', '', col)
+    fmt = negotiate_format()
+    if fmt is None:
+        return json_error(406, "requested format is not supported")
+    statement = statements.get('get_counts', cleaned_col)
     try:
-        if cleaned_col == 'id':
+        if statement is None:
             return json_error(403,
                               "column '{0}' is not allowed".format(cleaned_col))
-        con, cur = cursor_connect(db_dsn, psycopg2.extras.DictCursor)
-        query = """
-        SELECT {0}, COUNT(*) AS num FROM {1}
-        GROUP BY {0};""".format(cleaned_col, TABLE_NAME)
-        cur.execute(query, (cleaned_col, ))
-        result = cur.fetchall()
-        for row in result:
-            label = row[cleaned_col]
-            count[label] = row['num']
+        result = run_statement(statement)
+        profile(statement)
+        if fmt != 'json':
+            kind = schema.COLUMNS[cleaned_col]
+            return columnar_response(
+                [(cleaned_col, kind), ('num', columnar.BIGINT)], result, fmt)
+        for label, num in result:
+            count[label] = num
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({'error': e.message})
     return jsonify(count)
 
 
-@app.route('/api/v1/average/<col>')
+@api.route('/api/v1/average/<col>')
+@admitted('get_average')
 def get_average(col):
     """
     Get the average value from a column.
@@ -175,40 +1078,32 @@ def get_average(col):
         that column as the value, as the value for key 'average'.
     """
     avg = {}
-    # Only allow average value computation on certain (numeric) columns
-    accepted_cols = (
-        "inpatient_reimbursement",
-        "inpatient_beneficiary_responsibility",
-        "inpatient_primary_payer_reimbursement",
-        "outpatient_reimbursement",
-        "outpatient_beneficiary_responsibility",
-        "outpatient_primary_payer_reimbursement",
-        "carrier_reimbursement",
-        "beneficiary_responsibility",
-        "primary_payer_reimbursement",
-        "part_a_coverage_months",
-        "part_b_coverage_months",
-        "hmo_coverage_months",
-        "part_d_coverage_months",
-    )
     # Strip the user input to alpha characters only
     cleaned_col = re.sub('\W+', '', col)
+    fmt = negotiate_format()
+    if fmt is None:
+        return json_error(406, "requested format is not supported")
+    statement = statements.get('get_average', cleaned_col)
     try:
-        if cleaned_col not in accepted_cols:
+        if statement is None:
             return json_error(403,
                               "column '{0}' is not allowed".format(cleaned_col))
-        con, cur = cursor_connect(db_dsn, psycopg2.extras.DictCursor)
-        query = "SELECT AVG({0}) FROM {1};".format(cleaned_col, TABLE_NAME)
-        cur.execute(query, (cleaned_col, ))
-        result = cur.fetchall()
+        result = run_statement(statement)
+        profile(statement)
+        if fmt != 'json':
+            return columnar_response(
+                [(cleaned_col, columnar.FLOAT)], result, fmt)
         for row in result:
-            avg[cleaned_col] = round(row['avg'], 2)
+            avg[cleaned_col] = round(row[0], 2)
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({'error': e.message})
     return jsonify({'average': avg})
 
 
-@app.route('/api/v1/freq/<col>')
+@api.route('/api/v1/freq/<col>')
+@admitted('disease_frequency')
 def disease_frequency(col):
     """
     Get the states in descending order of the percentage of disease claims,
@@ -231,53 +1126,700 @@ def disease_frequency(col):
     /api/v1/freq/diabetes
     """
     disease = []
-    accepted_cols = (
-        "end_stage_renal_disease",
-        "alzheimers_related_senile",
-        "heart_failure",
-        "chronic_kidney",
-        "cancer",
-        "chronic_obstructive_pulmonary",
-        "depression",
-        "diabetes",
-        "ischemic_heart",
-        "osteoporosis",
-        "rheumatoid_osteo_arthritis",
-        "stroke_ischemic_attack",
-    )
     # Strip the user input to alpha characters only
     cleaned_col = re.sub('\W+', '', col)
+    fmt = negotiate_format()
+    if fmt is None:
+        return json_error(406, "requested format is not supported")
+    statement = statements.get('disease_frequency', cleaned_col)
     try:
-        if cleaned_col not in accepted_cols:
+        if statement is None:
             return json_error(403,
                               "column '{0}' is not allowed".format(cleaned_col))
-        con, cur = cursor_connect(db_dsn, psycopg2.extras.DictCursor)
-        query = """
-        SELECT state, {1}/claims::float AS frequency FROM (SELECT
-        LHS.state AS state, {1}, claims FROM (SELECT state, count(*) AS
-        claims FROM {0} GROUP BY state order by claims desc)
-        AS LHS LEFT JOIN (SELECT state, count(*) AS {1} FROM
-        {0} WHERE {1}='true' GROUP BY state) AS RHS
-        ON LHS.state=RHS.state) AS outer_q
-        ORDER by frequency DESC;""".format(TABLE_NAME, cleaned_col)
-        cur.execute(query)
-        result = cur.fetchall()
-        for row in result:
-            freq = {row['state']: row['frequency']}
+        result = run_statement(statement)
+        profile(statement)
+        if fmt != 'json':
+            return columnar_response(
+                [('state', schema.STATE), ('frequency', columnar.FLOAT)],
+                result, fmt)
+        for state, frequency in result:
+            freq = {state: frequency}
             disease.append(freq)
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({'error': e.message})
     return jsonify(state_depression=disease)
 
 
+@api.route('/api/v1/rows')
+def get_rows():
+    """
+    Export raw rows, ordered by `id`, as newline-delimited JSON, CSV, Arrow
+    or Parquet.
+
+    Results are paginated by keyset on `id`: pass the `id` of the last row
+    received as `after` to get the next page. The `id` column is always
+    returned first, whether it was requested or not. Rows are streamed from a
+    server-side cursor, so memory use is constant no matter the `limit`.
+
+    Parameters
+    ----------
+    cols : str, unicode, optional
+        Comma-separated column names to return. Defaults to all columns.
+    after : str, unicode, optional
+        Only return rows with an `id` greater than this one.
+    limit : int, optional
+        The maximum number of rows to return.
+    format : {'ndjson', 'csv', 'arrow', 'parquet'}, optional
+        The output format. Defaults to Arrow or Parquet if the Accept header
+        asks for them, otherwise 'ndjson'.
+    <column> : str, unicode, optional
+        Any other query parameter is an equality filter on that column.
+        Repeating a parameter matches any of the given values.
+
+    Returns
+    -------
+    response
+        A streaming response in the requested format.
+
+    Examples
+    --------
+    /api/v1/rows?cols=state,sex,cancer&state=CA&cancer=true
+    /api/v1/rows?after=00013D2EFD8E45D1&limit=1000&format=csv
+    """
+    reserved_args = ('cols', 'after', 'limit', 'format')
+    fmt = request.args.get('format')
+    if not fmt:
+        fmt = negotiate_format()
+        if fmt in (None, 'json'):
+            fmt = 'ndjson'
+    if fmt not in ('ndjson', 'csv', columnar.ARROW, columnar.PARQUET):
+        return json_error(400, "format '{0}' is not supported".format(fmt))
+    # Validate the projection against the table's columns
+    cols = ['id']
+    requested_cols = request.args.get('cols')
+    if requested_cols:
+        for col in requested_cols.split(','):
+            col = col.strip()
+            if col not in schema.COLUMNS:
+                return json_error(400,
+                                  "column '{0}' does not exist".format(col))
+            if col not in cols:
+                cols.append(col)
+    else:
+        cols = list(schema.COLUMNS)
+    try:
+        limit = int(request.args.get('limit', ROWS_DEFAULT_LIMIT))
+    except ValueError:
+        return json_error(400, "limit must be an integer")
+    if not 0 < limit <= ROWS_MAX_LIMIT:
+        return json_error(400, "limit must be between 1 and {0}".format(
+                          ROWS_MAX_LIMIT))
+    # Build the WHERE clause from validated filters, using query parameters
+    # for all of the values
+    filters = dict((col, request.args.getlist(col)) for col in request.args
+                   if col not in reserved_args)
+    try:
+        conditions, params = filter_conditions(filters)
+    except ValueError as e:
+        return json_error(400, str(e))
+    after = request.args.get('after')
+    if after:
+        conditions.append("id > %s")
+        params.append(after)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    query = "SELECT {0} FROM {1} {2} ORDER BY id LIMIT %s;".format(
+        ", ".join(cols), TABLE_NAME, where)
+    params.append(limit)
+
+    def iter_rows():
+        # Merge the rows of every shard, which are each in order of id
+        connections = []
+        try:
+            for router in get_shards().routers:
+                con, cur = cursor_connect(router.pick().dsn,
+                                          name='rows_export')
+                connections.append((con, cur))
+                set_statement_timeout(con, 'get_rows')
+                cur.itersize = ROWS_BATCH_SIZE
+                cur.execute(query, params)
+            merged = heapq.merge(*[cur for _, cur in connections])
+            for row in itertools.islice(merged, limit):
+                yield row
+        finally:
+            for con, cur in connections:
+                cur.close()
+                con.close()
+
+    def generate():
+        rows = iter_rows()
+        try:
+            buf = _LineBuffer()
+            writer = csv.writer(buf, lineterminator='\n')
+            if fmt == 'csv':
+                writer.writerow(cols)
+            num_lines = 0
+            for row in rows:
+                if fmt == 'csv':
+                    writer.writerow(row)
+                else:
+                    buf.write(json.dumps(OrderedDict(zip(cols, row)),
+                                         default=_json_default) + '\n')
+                num_lines += 1
+                if num_lines == ROWS_BATCH_SIZE:
+                    yield buf.drain()
+                    num_lines = 0
+            yield buf.drain()
+        finally:
+            rows.close()
+
+    def generate_columnar():
+        kinds = [schema.COLUMNS[col] for col in cols]
+        rows = iter_rows()
+        try:
+            def batches():
+                while True:
+                    batch = list(itertools.islice(rows, ROWS_BATCH_SIZE))
+                    if not batch:
+                        break
+                    yield columnar.record_batch(cols, kinds, batch)
+
+            for data in columnar.stream_batches(
+                    batches(), columnar.arrow_schema(cols, kinds), fmt):
+                yield data
+        finally:
+            rows.close()
+
+    # Hold the admission slot until the whole response has been streamed
+    admission.acquire('get_rows')
+    if fmt in columnar.MIMETYPES:
+        response = Response(generate_columnar(),
+                            mimetype=columnar.MIMETYPES[fmt])
+    else:
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        response = Response(generate(), mimetype=mimetype)
+    response.call_on_close(lambda: admission.release('get_rows'))
+    return response
+
+
+@api.route('/api/v1/cohort')
+@admitted('get_cohort')
+def get_cohort():
+    """
+    Count the beneficiaries matching a combination of conditions, overall and
+    by state.
+
+    Parameters
+    ----------
+    q : str, unicode
+        A cohort expression. Terms are disease column names, or
+        'sex:<value>', 'race:<value>' and 'state:<value>'. Terms can be
+        combined with AND, OR and NOT and grouped with parentheses.
+
+    Returns
+    -------
+    json
+        The query, the number of beneficiaries in the cohort as 'count', the
+        number of beneficiaries in the table as 'total', and the cohort's
+        count in each state as 'states'.
+
+    Examples
+    --------
+    /api/v1/cohort?q=diabetes AND heart_failure AND state:CA
+    /api/v1/cohort?q=depression AND NOT (sex:male OR race:white)
+    """
+    expression = request.args.get('q', '')
+    try:
+        index = get_cohort_index()
+        cohort = index.evaluate(expression)
+        states = index.state_counts(cohort)
+    except ValueError as e:
+        return json_error(400, str(e))
+    except psycopg2.Error as e:
+        return json_error(500, e.message)
+    return jsonify(query=expression, count=len(cohort), total=index.size,
+                   states=states)
+
+
+def rollup_rows(endpoint, sql, params=()):
+    """
+    Get rollup rows from the result cache, querying every shard and summing
+    their rows on a miss.
+
+    Parameters
+    ----------
+    endpoint : str, unicode
+        Name of the endpoint, whose statement timeout applies.
+    sql : str, unicode
+        A query from `db.rollups`.
+    params : tuple
+        Parameters of the query, which are also part of the cache key.
+
+    Returns
+    -------
+    list of tuple
+        The rows, each a state or county followed by `rollups.METRICS`.
+    """
+    key = (endpoint, ) + tuple(params)
+    generation = result_cache.generation
+    result = result_cache.get(key)
+    if result is None:
+        partials = query_shards(endpoint,
+                                lambda cur: cur.execute(sql, params))
+        result = merge_sums(partials)
+        result_cache.set(key, result, generation)
+    return result
+
+
+def rollup_page(rows, key):
+    """
+    Sort and paginate rollup rows as asked by the request's `sort`, `order`,
+    `limit`, `offset` and `metrics` query parameters.
+
+    Parameters
+    ----------
+    rows : list of tuple
+        The result of `rollup_rows()`.
+    key : str, unicode
+        Name of the first value of each row, 'state' or 'county_code'.
+
+    Returns
+    -------
+    dict
+        The page of results and how it was sorted and paginated.
+
+    Raises
+    ------
+    ValueError
+        If a query parameter is invalid.
+    """
+    names = (key, ) + rollups.METRICS
+    sort = request.args.get('sort', 'beneficiaries')
+    if sort not in names:
+        raise ValueError("can't sort by '{0}'".format(sort))
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'")
+    try:
+        limit = int(request.args.get('limit', GEO_DEFAULT_LIMIT))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        raise ValueError("limit and offset must be integers")
+    if not 0 < limit <= GEO_MAX_LIMIT:
+        raise ValueError("limit must be between 1 and {0}".format(
+                         GEO_MAX_LIMIT))
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+    metrics = list(rollups.METRICS)
+    if request.args.get('metrics'):
+        metrics = [metric.strip()
+                   for metric in request.args['metrics'].split(',')]
+        for metric in metrics:
+            if metric not in rollups.METRICS:
+                raise ValueError("metric '{0}' does not exist".format(metric))
+    i = names.index(sort)
+    ordered = sorted(rows, key=lambda row: (row[i], row[0]),
+                     reverse=order == 'desc')
+    results = []
+    for row in ordered[offset:offset + limit]:
+        values = dict(zip(names, row))
+        results.append(dict((name, values[name]) for name in [key] + metrics))
+    return dict(total=len(rows), sort=sort, order=order, limit=limit,
+                offset=offset, results=results)
+
+
+@api.route('/api/v1/geo/states')
+@admitted('geo_states')
+def geo_states():
+    """
+    List the number of beneficiaries, the number with each disease and the
+    total of each payment in every state, from the state rollup.
+
+    Parameters
+    ----------
+    sort : str, unicode, optional
+        The metric to sort by, or 'state'. Defaults to 'beneficiaries'.
+    order : {'desc', 'asc'}, optional
+        The sort order. Defaults to 'desc'.
+    limit : int, optional
+        The maximum number of states to return.
+    offset : int, optional
+        The number of states to skip.
+    metrics : str, unicode, optional
+        Comma-separated metrics to return. Defaults to all of them.
+
+    Returns
+    -------
+    json
+        The page of states as 'results', and the number of states as 'total'.
+
+    Examples
+    --------
+    /api/v1/geo/states?sort=diabetes&limit=10
+    /api/v1/geo/states?metrics=beneficiaries,carrier_reimbursement&order=asc
+    """
+    try:
+        rows = rollup_rows('geo_states', rollups.states_sql(TABLE_NAME))
+        page = rollup_page(rows, 'state')
+    except ValueError as e:
+        return json_error(400, str(e))
+    except psycopg2.Error as e:
+        return json_error(500, e.message)
+    return jsonify(page)
+
+
+@api.route('/api/v1/geo/states/<state>/counties')
+@admitted('geo_counties')
+def geo_counties(state):
+    """
+    List the number of beneficiaries, the number with each disease and the
+    total of each payment in every county of a state, from the county rollup.
+
+    Parameters
+    ----------
+    state : str, unicode
+        The state's abbreviation, as in the state rollup.
+    sort : str, unicode, optional
+        The metric to sort by, or 'county_code'. Defaults to 'beneficiaries'.
+    order, limit, offset, metrics : optional
+        As for /api/v1/geo/states.
+
+    Returns
+    -------
+    json
+        The page of counties as 'results', and the number of counties in the
+        state as 'total'.
+
+    Examples
+    --------
+    /api/v1/geo/states/CA/counties?sort=cancer&limit=20&offset=20
+    """
+    if state not in schema.STATE_VALUES:
+        return json_error(404, "state '{0}' does not exist".format(state))
+    try:
+        rows = rollup_rows('geo_counties', rollups.counties_sql(TABLE_NAME),
+                           (state, ))
+        page = rollup_page(rows, 'county_code')
+    except ValueError as e:
+        return json_error(400, str(e))
+    except psycopg2.Error as e:
+        return json_error(500, e.message)
+    page['state'] = state
+    return jsonify(page)
+
+
+def age_groups(endpoint):
+    """
+    Get the age bands of each group of beneficiaries, grouped by the column
+    in the request's `by` query parameter, from the age rollup.
+
+    Parameters
+    ----------
+    endpoint : str, unicode
+        Name of the endpoint, whose statement timeout applies.
+
+    Returns
+    -------
+    (str, unicode or None, list of tuple)
+        The `by` column, and a (group, bands) tuple for each group in order,
+        where bands holds a (label, beneficiaries, deaths) tuple for each of
+        `ages.AGE_BANDS`.
+
+    Raises
+    ------
+    ValueError
+        If the `by` column can't be broken down by.
+    """
+    by = request.args.get('by') or None
+    if by is not None and by not in ages.BY_COLUMNS:
+        raise ValueError("can't break ages down by '{0}'".format(by))
+    key = ('age_bands', by)
+    generation = result_cache.generation
+    rows = result_cache.get(key)
+    if rows is None:
+        sql = ages.bands_sql(TABLE_NAME, by)
+        partials = query_shards(endpoint, lambda cur: cur.execute(sql))
+        rows = merge_sums(partials, keys=2)
+        result_cache.set(key, rows, generation)
+    counts = {}
+    for group, band, beneficiaries, deaths in rows:
+        counts[(group, band)] = (beneficiaries, deaths)
+    groups = []
+    for group in sorted(set(group for group, _, _, _ in rows)):
+        bands = [(ages.band_label(band), ) + counts.get((group, band), (0, 0))
+                 for band in ages.AGE_BANDS]
+        if by in schema.DISEASE_COLUMNS:
+            group = group == 'true'
+        groups.append((group, bands))
+    return by, groups
+
+
+@api.route('/api/v1/age/distribution')
+@admitted('age_distribution')
+def age_distribution():
+    """
+    Get the number and share of beneficiaries in each age band, optionally
+    for each value of a column, from the precomputed age rollup. Ages are
+    taken on `ages.REFERENCE_DATE`.
+
+    Parameters
+    ----------
+    by : str, unicode, optional
+        'state', 'sex' or a disease column to break the age bands down by.
+
+    Returns
+    -------
+    json
+        The age bands of each group, with the number of beneficiaries and
+        their share of the group.
+
+    Examples
+    --------
+    /api/v1/age/distribution
+    /api/v1/age/distribution?by=sex
+    """
+    try:
+        by, groups = age_groups('age_distribution')
+    except ValueError as e:
+        return json_error(400, str(e))
+    except psycopg2.Error as e:
+        return json_error(500, e.message)
+    results = []
+    for group, bands in groups:
+        total = sum(beneficiaries for _, beneficiaries, _ in bands)
+        result = {
+            'beneficiaries': total,
+            'bands': [{'age_band': label,
+                       'beneficiaries': beneficiaries,
+                       'share': round(beneficiaries / total, 4) if total
+                       else None}
+                      for label, beneficiaries, _ in bands],
+        }
+        if by is not None:
+            result[by] = group
+        results.append(result)
+    return jsonify(by=by, reference_date=ages.REFERENCE_DATE, results=results)
+
+
+@api.route('/api/v1/age/mortality')
+@admitted('age_mortality')
+def age_mortality():
+    """
+    Get the mortality rate in each age band, optionally for each value of a
+    column, from the precomputed age rollup.
+
+    Parameters
+    ----------
+    by : str, unicode, optional
+        'state', 'sex' or a disease column to break the age bands down by.
+
+    Returns
+    -------
+    json
+        The number of beneficiaries and deaths, and the share who died, in
+        each age band of each group and in the group as a whole.
+
+    Examples
+    --------
+    /api/v1/age/mortality
+    /api/v1/age/mortality?by=heart_failure
+    """
+    try:
+        by, groups = age_groups('age_mortality')
+    except ValueError as e:
+        return json_error(400, str(e))
+    except psycopg2.Error as e:
+        return json_error(500, e.message)
+
+    def rate(deaths, beneficiaries):
+        return round(deaths / beneficiaries, 4) if beneficiaries else None
+
+    results = []
+    for group, bands in groups:
+        total = sum(beneficiaries for _, beneficiaries, _ in bands)
+        total_deaths = sum(deaths for _, _, deaths in bands)
+        result = {
+            'beneficiaries': total,
+            'deaths': total_deaths,
+            'mortality_rate': rate(total_deaths, total),
+            'bands': [{'age_band': label,
+                       'beneficiaries': beneficiaries,
+                       'deaths': deaths,
+                       'mortality_rate': rate(deaths, beneficiaries)}
+                      for label, beneficiaries, deaths in bands],
+        }
+        if by is not None:
+            result[by] = group
+        results.append(result)
+    return jsonify(by=by, reference_date=ages.REFERENCE_DATE, results=results)
+
+
+@api.route('/api/v1/ready')
+def readiness():
+    """
+    Report whether the worker has finished warming up its caches.
+
+    Returns
+    -------
+    json
+        The warm-up status, the health of each DB node and the last data
+        version the worker was notified of, with status code 200 once the
+        worker is ready and 503 before then.
+    """
+    status = dict(warmup_status, cached_results=len(result_cache),
+                  databases=get_shards().status(),
+                  data_version=data_listener.version if data_listener
+                  else None)
+    response = jsonify(status)
+    response.status_code = 200 if status['ready'] else 503
+    return response
+
+
+@api.route('/api/v1/admission')
+def admission_stats():
+    """
+    Report the admission control state of each endpoint.
+
+    Returns
+    -------
+    json
+        For each endpoint, requests running and queued now, and the number
+        admitted, rejected and cancelled by the statement timeout so far.
+    """
+    return jsonify(admission.stats())
+
+
+@api.route('/api/v1/jobs', methods=['POST'])
+@admitted('jobs')
+def submit_job():
+    """
+    Submit a query to run in the background.
+
+    An identical query that is queued, running or has an unexpired result is
+    not run again: its job is returned instead.
+
+    Returns
+    -------
+    json
+        The job, with status code 202 and a Location header to poll.
+
+    Examples
+    --------
+    POST /api/v1/jobs {"type": "group_by", "cols": ["state", "county_code"]}
+    POST /api/v1/jobs {"type": "freq", "col": "diabetes"}
+    """
+    try:
+        spec = validate_job(request.get_json(force=True, silent=True))
+    except ValueError as e:
+        return json_error(400, str(e))
+    job, created = jobs.submit(spec)
+    response = jsonify(job.to_dict(with_result=False), created=created)
+    response.status_code = 202
+    response.headers['Location'] = '/api/v1/jobs/{0}'.format(job.id)
+    return response
+
+
+@api.route('/api/v1/jobs/<job_id>', methods=['GET'])
+@admitted('jobs')
+def get_job(job_id):
+    """
+    Get the status of a job, and its result once it is done.
+
+    Returns
+    -------
+    json
+        The job, or a 404 error if it doesn't exist or has expired.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return json_error(404, "job '{0}' not found".format(job_id))
+    return jsonify(job.to_dict())
+
+
+@api.route('/api/v1/jobs/<job_id>', methods=['DELETE'])
+@admitted('jobs')
+def cancel_job(job_id):
+    """
+    Cancel a job, cancelling its query if it is running.
+
+    Returns
+    -------
+    json
+        The job, or a 404 error if it doesn't exist or has expired.
+    """
+    job = jobs.cancel(job_id)
+    if job is None:
+        return json_error(404, "job '{0}' not found".format(job_id))
+    return jsonify(job.to_dict(with_result=False))
+
+
+@api.route('/api/v1/admin/profile', methods=['GET', 'DELETE'])
+def query_profile():
+    """
+    Report the query profiles collected so far, or drop them with DELETE.
+
+    Returns
+    -------
+    json
+        For each query shape, the number of profiled samples, their mean and
+        maximum execution time, shared buffers hit and read, temp buffers
+        used and the tables scanned sequentially; and the plans of the
+        slowest samples. A 404 error if profiling is off.
+    """
+    if not profiler.enabled:
+        return json_error(404, "query profiling is off")
+    if request.method == 'DELETE':
+        profiler.reset()
+    return jsonify(profiler.report())
+
+
+def create_app(dev=False, profile_sample_rate=0.0):
+    """
+    Create the Flask app.
+
+    Creating the app makes no DB connections, so it is safe to do in
+    Gunicorn's master process before the workers are forked.
+
+    Parameters
+    ----------
+    dev : bool
+        Connect to the Vagrant databases instead of RDS.
+    profile_sample_rate : float
+        Fraction of count, average and frequency requests whose query is
+        profiled with EXPLAIN ANALYZE, see /api/v1/admin/profile. 0 turns
+        profiling off.
+
+    Returns
+    -------
+    flask.Flask
+    """
+    global statements
+    locale.setlocale(locale.LC_ALL, '')  # For formatting numbers with commas
+    configure_databases(dev)
+    statements = build_statements()
+    profiler.sample_rate = profile_sample_rate
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app
+
+
 if __name__ == '__main__':
     # NOTE: anything you put here won't get picked up in production
     current_dir = os.path.dirname(os.path.realpath(__file__))
     if os.path.isfile(os.path.join(current_dir, 'PRODUCTION')):
-        app.run()
+        create_app().run()
     else:
         # Running dev server...
-        db_dsn = "host={0} dbname={1} user={2}".format(dbconfig.vagrant_dbhost,
-                                                       dbconfig.vagrant_dbname,
-                                                       dbconfig.vagrant_dbuser)
+        app = create_app(dev=True)
+        # Warm up in the background of the reloader's child process, which is
+        # the one that serves requests, then listen for reloads from the
+        # version the caches were filled from
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            def warm_up_and_listen():
+                warm_up()
+                listen_for_reloads()
+            warmup_thread = threading.Thread(target=warm_up_and_listen)
+            warmup_thread.daemon = True
+            warmup_thread.start()
         app.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,18 @@
+"""WSGI entry point of the API, for Gunicorn::
+
+    gunicorn wsgi:app -c config/gunicorn.conf.py
+
+Set PROFILE_SAMPLE_RATE in the environment, e.g. to 0.01, to profile that
+fraction of queries (see /api/v1/admin/profile).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+from server import create_app
+
+app = create_app(
+    profile_sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))